@@ -2,55 +2,121 @@
 RTA Break Tracker - Web Application
 Flask-based web app for tracking agent breaks
 """
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, Response
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_from_directory, send_file, Response, abort, g, has_app_context
 from flask_login import LoginManager, UserMixin, login_user, logout_user, login_required, current_user
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
 from werkzeug.utils import secure_filename
-from datetime import datetime, timedelta
+from werkzeug.security import safe_join
+from werkzeug.middleware.proxy_fix import ProxyFix
+from datetime import datetime, date, time, timedelta
 from pathlib import Path
 import bcrypt
+import orjson
+from PIL import Image
 import os
 import uuid
+import secrets
+import hashlib
+import tempfile
 import io
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+from functools import lru_cache
+from itertools import count
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ThreadPoolExecutor, wait as wait_for_futures
+from time import monotonic, sleep
 
 from config import (
-    SECRET_KEY, SQLALCHEMY_DATABASE_URI, UPLOAD_FOLDER, 
-    ALLOWED_EXTENSIONS, BREAK_DURATIONS, BREAK_INFO,
-    ROLE_AGENT, ROLE_RTM, DEFAULT_USERS, DEBUG, ENV, TIMEZONE
+    SECRET_KEY, SQLALCHEMY_DATABASE_URI, SQLALCHEMY_ENGINE_OPTIONS, UPLOAD_FOLDER, 
+    UPLOADS_ACCEL_REDIRECT, ALLOWED_EXTENSIONS, BREAK_DURATIONS, BREAK_INFO,
+    ROLE_AGENT, ROLE_RTM, get_default_users, DEBUG, ENV, TIMEZONE, INIT_DB_ON_STARTUP,
+    BCRYPT_ROUNDS, SHIFT_WORKING_MINUTES, SHIFT_BREAK_ALLOWANCE_MINUTES,
+    PUNCH_GRACE_MINUTES, PUNCH_MAX_PENALTY_MINUTES, MAX_REPORT_RANGE_DAYS,
+    REPORT_EXPORT_FOLDER, REPORT_JOB_TTL_SECONDS, REPORT_JOB_MAX_BUILD_SECONDS, LOGIN_MAX_FAILURES, LOGIN_FAILURE_WINDOW_SECONDS,
+    TRUSTED_PROXY_COUNT
 )
-import pytz
 
 # Break types that count as working time (meetings/coaching/overtime)
-WORKING_TIME_BREAKS = ['coaching_aya', 'coaching_mostafa', 'meeting_team_leader', 'overtime']
+WORKING_TIME_BREAKS = frozenset({'coaching_aya', 'coaching_mostafa', 'meeting_team_leader', 'overtime'})
+# Attendance records - auto-completed instantly and never counted as breaks
+PUNCH_TYPES = frozenset({'punch_in', 'punch_out'})
+# Break types that are not counted as regular breaks in metrics
+NON_REGULAR_BREAK_TYPES = WORKING_TIME_BREAKS | PUNCH_TYPES | {'compensation'}
+# Break types that are never overdue (working time, and compensation for missed work hours)
+NEVER_OVERDUE_BREAK_TYPES = WORKING_TIME_BREAKS | {'compensation'}
+# Display info for break types missing from BREAK_INFO (the name is filled in per type)
+UNKNOWN_BREAK_INFO = {"emoji": "⏱️", "color": "#666"}
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 from openpyxl.utils import get_column_letter
+from openpyxl.cell import WriteOnlyCell
+
+# Errors in request handlers are logged through a queue so writing them to stdout
+# happens on a background thread instead of blocking the request
+logger = logging.getLogger('rta')
+logger.setLevel(logging.INFO)
+logger.propagate = False
+_log_queue = queue.Queue(-1)
+logger.addHandler(logging.handlers.QueueHandler(_log_queue))
+_log_listener = logging.handlers.QueueListener(_log_queue, logging.StreamHandler())
+_log_listener.start()
+atexit.register(_log_listener.stop)
 
 def get_local_time():
-    """Get current time in configured timezone"""
-    return datetime.now(TIMEZONE)
-
-def to_local_time(dt):
-    """Return datetime as-is (already stored in local time)"""
-    if dt is None:
-        return None
-    # Times are stored in local timezone already, just return as-is
-    return dt
+    """Get current time in configured timezone.
+    Read once per request (cached on flask.g) so every use within a request agrees."""
+    if not has_app_context():
+        return datetime.now(TIMEZONE)
+    if '_local_now' not in g:
+        g._local_now = datetime.now(TIMEZONE)
+    return g._local_now
 
 # Initialize Flask app
 app = Flask(__name__)
+if TRUSTED_PROXY_COUNT:
+    # Behind the host's proxy request.remote_addr would be the proxy for every client
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=TRUSTED_PROXY_COUNT)
 app.config['SECRET_KEY'] = SECRET_KEY
 app.config['SQLALCHEMY_DATABASE_URI'] = SQLALCHEMY_DATABASE_URI
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = SQLALCHEMY_ENGINE_OPTIONS
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['UPLOAD_FOLDER'] = str(UPLOAD_FOLDER)
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024
 
+# Break type tables are static, so templates get them once as globals
+# instead of through every render_template call
+app.jinja_env.globals.update(break_types=BREAK_INFO, break_durations=BREAK_DURATIONS)
+
 # Initialize extensions
 db = SQLAlchemy(app)
+
+if SQLALCHEMY_DATABASE_URI.startswith('sqlite'):
+    # WAL lets the dashboard polls read while a break/upload commit is writing,
+    # and synchronous=NORMAL skips the fsync on every commit (safe with WAL)
+    @event.listens_for(Engine, 'connect')
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA journal_mode=WAL')
+        cursor.execute('PRAGMA synchronous=NORMAL')
+        cursor.close()
 login_manager = LoginManager(app)
 login_manager.login_view = 'login'
 login_manager.login_message = 'Please log in to access this page.'
 
+# Background report builds, so large exports don't hold a request worker.
+# Job state is kept in REPORT_EXPORT_FOLDER, not in this process
+_report_executor = ThreadPoolExecutor(max_workers=2)
+
+# Listing queries pass agent names in explicitly and never touch relationships.
+# In development make any lazy load on them raise, so a per-row query can't sneak back in
+LISTING_QUERY_OPTIONS = (db.raiseload('*'),) if DEBUG else ()
+
 # ==================== MODELS ====================
 
 class User(UserMixin, db.Model):
@@ -71,14 +137,29 @@ class User(UserMixin, db.Model):
         return self.role == ROLE_AGENT
     
     def set_password(self, password):
-        self.password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+        self.password_hash = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt(BCRYPT_ROUNDS)).decode('utf-8')
     
     def check_password(self, password):
         return bcrypt.checkpw(password.encode('utf-8'), self.password_hash.encode('utf-8'))
+    
+    def password_needs_rehash(self):
+        """True if the stored hash was made with a lower bcrypt cost ($2b$<cost>$...).
+        Stronger hashes are kept, so lowering BCRYPT_ROUNDS never weakens stored passwords."""
+        try:
+            return int(self.password_hash.split('$')[2]) < BCRYPT_ROUNDS
+        except (IndexError, ValueError):
+            return True
 
 
 class Shift(db.Model):
     """Shift model for tracking agent work schedules"""
+    __table_args__ = (
+        # Shift lookups always filter by agent and then by start date, often checking end date too.
+        # On Postgres the times ride along so the metrics shift query is an index-only scan
+        db.Index('ix_shift_agent_start', 'agent_id', 'start_date', 'end_date',
+                 postgresql_include=['start_time', 'end_time']),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     agent_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     start_date = db.Column(db.Date, nullable=False)
@@ -89,35 +170,41 @@ class Shift(db.Model):
     shift_date = db.Column(db.Date, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     created_by = db.Column(db.Integer, db.ForeignKey('user.id'))
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     agent = db.relationship('User', foreign_keys=[agent_id], backref='shifts')
     
-    def get_duration_hours(self):
-        """Calculate shift duration in hours"""
-        start = datetime.combine(self.start_date, self.start_time)
-        end = datetime.combine(self.end_date, self.end_time)
-        return (end - start).total_seconds() / 3600
-    
     def get_shift_date(self):
         """Get the primary shift date (start date) for backward compatibility"""
         return self.start_date
     
     def to_dict(self):
+        return Shift.row_to_dict(self, self.agent.full_name if self.agent else None)
+    
+    @staticmethod
+    def row_to_dict(row, agent_name):
+        """Serialize a Shift or a plain column row with the same attribute names"""
+        duration = (datetime.combine(row.end_date, row.end_time)
+                    - datetime.combine(row.start_date, row.start_time))
         return {
-            'id': self.id,
-            'agent_id': self.agent_id,
-            'agent_name': self.agent.full_name if self.agent else 'Unknown',
-            'start_date': self.start_date.isoformat(),
-            'start_time': self.start_time.strftime('%H:%M'),
-            'end_date': self.end_date.isoformat(),
-            'end_time': self.end_time.strftime('%H:%M'),
-            'shift_date': self.start_date.isoformat(),  # For backward compatibility
-            'duration_hours': round(self.get_duration_hours(), 2)
+            'id': row.id,
+            'agent_id': row.agent_id,
+            'agent_name': agent_name or 'Unknown',
+            'start_date': row.start_date.isoformat(),
+            'start_time': row.start_time.strftime('%H:%M'),
+            'end_date': row.end_date.isoformat(),
+            'end_time': row.end_time.strftime('%H:%M'),
+            'shift_date': row.start_date.isoformat(),  # For backward compatibility
+            'duration_hours': round(duration.total_seconds() / 3600, 2)
         }
 
 
 class OffDay(db.Model):
     """Off day model for tracking agent days off"""
+    __table_args__ = (
+        db.Index('ix_offday_agent_date', 'agent_id', 'off_date'),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     agent_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     off_date = db.Column(db.Date, nullable=False)
@@ -128,18 +215,38 @@ class OffDay(db.Model):
     agent = db.relationship('User', foreign_keys=[agent_id], backref='off_days')
     
     def to_dict(self):
+        return OffDay.row_to_dict(self, self.agent.full_name if self.agent else None)
+    
+    @staticmethod
+    def row_to_dict(row, agent_name):
+        """Serialize an OffDay or a plain column row with the same attribute names"""
         return {
-            'id': self.id,
-            'agent_id': self.agent_id,
-            'agent_name': self.agent.full_name if self.agent else 'Unknown',
-            'off_date': self.off_date.isoformat(),
-            'reason': self.reason,
-            'created_at': self.created_at.isoformat() if self.created_at else None
+            'id': row.id,
+            'agent_id': row.agent_id,
+            'agent_name': agent_name or 'Unknown',
+            'off_date': row.off_date.isoformat(),
+            'reason': row.reason,
+            'created_at': row.created_at.isoformat() if row.created_at else None
         }
 
 
 class BreakRecord(db.Model):
     """Break record model"""
+    __table_args__ = (
+        # Metric and punch lookups filter by agent, classify by type and range over start_time.
+        # On Postgres the grouped metrics columns ride along so that query skips the table
+        db.Index('ix_break_agent_type_start', 'agent_id', 'break_type', 'start_time',
+                 postgresql_include=['duration_minutes', 'is_overdue', 'end_time']),
+        # Active-break checks and per-agent day views filter by agent, start_time and open end_time
+        db.Index('ix_break_agent_start_end', 'agent_id', 'start_time', 'end_time'),
+        # Dashboard day totals range over start_time across all agents
+        db.Index('ix_break_start', 'start_time'),
+        # Active-break checks and the dashboard's active count only look at open rows
+        db.Index('ix_break_active_partial', 'agent_id',
+                 postgresql_where=db.text('end_time IS NULL'),
+                 sqlite_where=db.text('end_time IS NULL')),
+    )
+    
     id = db.Column(db.Integer, primary_key=True)
     agent_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     break_type = db.Column(db.String(20), nullable=False)
@@ -151,102 +258,355 @@ class BreakRecord(db.Model):
     is_overdue = db.Column(db.Boolean, default=False)
     notes = db.Column(db.Text, default='')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
     def is_active(self):
         return self.end_time is None
     
-    def get_elapsed_minutes(self):
+    def get_elapsed_minutes(self, now=None):
         if self.start_time:
             # Both times are in local timezone
-            now = get_local_time().replace(tzinfo=None)
+            if now is None:
+                now = get_local_time().replace(tzinfo=None)
             elapsed = now - self.start_time
             return max(0, int(elapsed.total_seconds() / 60))
         return 0
     
     def get_break_info(self):
-        return BREAK_INFO.get(self.break_type, {"name": self.break_type, "emoji": "⏱️", "color": "#666"})
+        return BREAK_INFO.get(self.break_type) or {**UNKNOWN_BREAK_INFO, "name": self.break_type}
     
     def get_allowed_duration(self):
         return BREAK_DURATIONS.get(self.break_type, 15)
     
-    def is_working_time_break(self):
-        """Check if this break counts as working time (coaching/meetings)"""
-        return self.break_type in WORKING_TIME_BREAKS
-    
-    def get_effective_overdue_status(self):
-        """Get overdue status, but always False for working time breaks and compensation"""
-        if self.is_working_time_break() or self.break_type == 'compensation':
-            return False
-        return self.is_overdue
-    
-    def get_local_start_time(self):
-        """Get start time in local timezone"""
-        if self.start_time:
-            return to_local_time(self.start_time)
-        return None
-    
-    def get_local_end_time(self):
-        """Get end time in local timezone"""
-        if self.end_time:
-            return to_local_time(self.end_time)
-        return None
-    
-    def to_dict(self):
+    def complete(self, end_time):
+        """End the break at end_time and derive duration_minutes/is_overdue from it.
+        This is the only place those two columns are computed."""
+        self.end_time = end_time
+        self.duration_minutes = int((end_time - self.start_time).total_seconds() / 60)
+        
+        # Working time breaks (coaching/meetings) and compensation should never be marked as overdue
+        # Working time breaks count as working time regardless of duration
+        # Compensation is for missed work hours, not a violation
+        if self.break_type in NEVER_OVERDUE_BREAK_TYPES:
+            self.is_overdue = False
+        else:
+            self.is_overdue = self.duration_minutes > self.get_allowed_duration()
+    
+    def to_dict(self, now=None, agent_name=None):
+        # Called for every row of the break listings, so the helpers are inlined here.
+        # Times are already stored in local time, so no conversion is needed.
+        # Listings pass `now` (naive local time) once instead of reading the clock per row,
+        # and `agent_name` from a prefetched map instead of loading the agent relationship
+        break_type = self.break_type
         info = self.get_break_info()
-        local_start = self.get_local_start_time()
-        local_end = self.get_local_end_time()
+        start = self.start_time
+        end = self.end_time
+        is_active = end is None
+        if agent_name is None:
+            agent_name = self.agent.full_name if self.agent else 'Unknown'
         return {
             'id': self.id,
             'agent_id': self.agent_id,
-            'agent_name': self.agent.full_name if self.agent else 'Unknown',
-            'break_type': self.break_type,
+            'agent_name': agent_name,
+            'break_type': break_type,
             'break_name': info['name'],
             'break_emoji': info['emoji'],
             'break_color': info['color'],
-            'start_time': local_start.isoformat() if local_start else None,
-            'end_time': local_end.isoformat() if local_end else None,
+            'start_time': start.isoformat() if start else None,
+            'end_time': end.isoformat() if end else None,
             'start_screenshot': self.start_screenshot,
             'end_screenshot': self.end_screenshot,
             'duration_minutes': self.duration_minutes,
-            'elapsed_minutes': self.get_elapsed_minutes() if self.is_active() else self.duration_minutes,
-            'is_active': self.is_active(),
-            'is_overdue': self.get_effective_overdue_status(),  # Use effective status (excludes working time breaks)
+            'elapsed_minutes': self.get_elapsed_minutes(now) if is_active else self.duration_minutes,
+            'is_active': is_active,
+            # Effective status (excludes working time breaks and compensation)
+            'is_overdue': False if break_type in NEVER_OVERDUE_BREAK_TYPES else self.is_overdue,
             'notes': self.notes or '',
-            'allowed_duration': self.get_allowed_duration()
+            'allowed_duration': BREAK_DURATIONS.get(break_type, 15)
         }
 
 
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
 
 # ==================== HELPERS ====================
 
+def started_on(first_day, last_day=None):
+    """Filter for breaks that started on first_day (through last_day, inclusive).
+    Uses a half-open range on start_time instead of date(start_time) so the
+    start_time indexes can be used."""
+    last_day = last_day or first_day
+    return db.and_(
+        BreakRecord.start_time >= datetime.combine(first_day, time.min),
+        BreakRecord.start_time < datetime.combine(last_day + timedelta(days=1), time.min)
+    )
+
+
+def latest_punch_times(agent_id, since=None, until=None):
+    """Latest punch_in/punch_out start times for an agent in one grouped query.
+    Returns {'punch_in': datetime, 'punch_out': datetime}, omitting types with no record."""
+    query = db.session.query(
+        BreakRecord.break_type, db.func.max(BreakRecord.start_time)
+    ).filter(
+        BreakRecord.agent_id == agent_id,
+        BreakRecord.break_type.in_(PUNCH_TYPES)
+    )
+    if since is not None:
+        query = query.filter(BreakRecord.start_time >= since)
+    if until is not None:
+        query = query.filter(BreakRecord.start_time < until)
+    return dict(query.group_by(BreakRecord.break_type).all())
+
+
+def breaks_etag(first_day, last_day):
+    """Fingerprint of everything /api/breaks output for first_day..last_day depends on, so
+    unchanged polls get a 304. Only breaks and shifts near the range are aggregated (the
+    range plus the two days either side that punch pairing can reach). Counts catch deletes,
+    max(updated_at) catches inserts and edits; while any break is active the minute is
+    included too, since elapsed_minutes changes with the clock."""
+    break_count, ended_count, breaks_updated = db.session.query(
+        db.func.count(BreakRecord.id), db.func.count(BreakRecord.end_time), db.func.max(BreakRecord.updated_at)
+    ).filter(
+        started_on(first_day - timedelta(days=2), last_day + timedelta(days=2))
+    ).one()
+    shift_count, shifts_updated = db.session.query(
+        db.func.count(Shift.id), db.func.max(Shift.updated_at)
+    ).filter(
+        Shift.start_date <= last_day, Shift.end_date >= first_day
+    ).one()
+    # Agent names are part of the output, so renames and new agents must change the tag too
+    roster = hashlib.sha1(repr(get_agent_roster()).encode('utf-8')).hexdigest()
+    
+    now = get_local_time()
+    clock = now.strftime('%Y-%m-%d %H:%M') if break_count > ended_count else now.strftime('%Y-%m-%d')
+    fingerprint = (f"{request.query_string!r}|{break_count}|{ended_count}|{breaks_updated}|"
+                   f"{shift_count}|{shifts_updated}|{roster}|{clock}")
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+
+
+def ojsonify(payload, status=200):
+    """Build a JSON response with orjson - much faster than jsonify for large payloads"""
+    return Response(orjson.dumps(payload), status=status, mimetype='application/json')
+
+
+# Cache invalidations take a fresh number from here (next() on a count is atomic).
+# A cached entry records the generation it was read under, so a refresh that raced
+# an invalidation is stale as soon as it is stored, whatever its TTL says
+_cache_generations = count(1)
+
+# The agent roster changes rarely but is read by most RTM endpoints,
+# so keep it for a short time instead of querying it on every request
+AGENT_ROSTER_TTL_SECONDS = 60
+# 'entry' is replaced as a whole: (generation, roster, expires_at)
+_agent_roster_cache = {'generation': 0, 'entry': None}
+
+
+def get_agent_roster():
+    """Get all agents as (id, username, full_name) rows, ordered by name"""
+    generation = _agent_roster_cache['generation']
+    entry = _agent_roster_cache['entry']
+    if entry is not None and entry[0] == generation and monotonic() < entry[2]:
+        return entry[1]
+    
+    # Plain rows rather than ORM objects so they are safe to share across sessions
+    roster = db.session.query(
+        User.id, User.username, User.full_name
+    ).filter_by(role=ROLE_AGENT).order_by(User.full_name).all()
+    _agent_roster_cache['entry'] = (generation, roster, monotonic() + AGENT_ROSTER_TTL_SECONDS)
+    return roster
+
+
+def invalidate_agent_roster():
+    """Drop the cached agent roster (call after agents are added or changed)"""
+    _agent_roster_cache['generation'] = next(_cache_generations)
+
+
+# The dashboard counters are re-read on every dashboard load but only change
+# when a break starts or ends, so a few seconds of staleness is fine
+BREAK_COUNTERS_TTL_SECONDS = 10
+# 'entry' is replaced as a whole: (generation, day, counters, expires_at)
+_break_counters_cache = {'generation': 0, 'entry': None}
+
+
+def get_break_counters(day):
+    """Get (total, active, overdue) break counts for a day, excluding punches"""
+    generation = _break_counters_cache['generation']
+    entry = _break_counters_cache['entry']
+    if entry is not None and entry[0] == generation and entry[1] == day and monotonic() < entry[3]:
+        return entry[2]
+    
+    # One scan with conditional counts instead of three COUNT queries.
+    # Active breaks are counted regardless of the day they started on
+    on_day = started_on(day)
+    active_now = BreakRecord.end_time.is_(None)
+    total, active, overdue = db.session.query(
+        db.func.count(db.case((on_day, 1))),
+        db.func.count(db.case((active_now, 1))),
+        db.func.count(db.case((db.and_(on_day, BreakRecord.is_overdue == True), 1)))
+    ).filter(
+        db.or_(on_day, active_now),
+        ~BreakRecord.break_type.in_(PUNCH_TYPES)
+    ).one()
+    
+    counters = (total, active, overdue)
+    _break_counters_cache['entry'] = (generation, day, counters, monotonic() + BREAK_COUNTERS_TTL_SECONDS)
+    return counters
+
+
+def invalidate_break_counters():
+    """Drop the cached dashboard counters (call after breaks are created or ended)"""
+    _break_counters_cache['generation'] = next(_cache_generations)
+
+
+# Uploaded screenshots are downscaled to fit this box and stored as WebP
+SCREENSHOT_MAX_SIZE = (1920, 1080)
+SCREENSHOT_WEBP_QUALITY = 82
+
+
 def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+    _, dot, ext = filename.rpartition('.')
+    return bool(dot) and ext.lower() in ALLOWED_EXTENSIONS
+
+
+@lru_cache(maxsize=32)
+def ensure_upload_dir(day):
+    """Create the date-based upload folder once per day instead of on every upload"""
+    folder = Path(app.config['UPLOAD_FOLDER']) / day
+    folder.mkdir(parents=True, exist_ok=True)
+    return folder
+
+
+# Screenshots are re-encoded after the request returns, so break start/end only
+# waits for the database write
+_screenshot_executor = ThreadPoolExecutor(max_workers=2)
+# Upload-relative path -> Future for screenshots this worker is still writing
+_pending_screenshots = {}
+# How long a request for a just-uploaded screenshot waits for it to be written
+SCREENSHOT_WRITE_WAIT_SECONDS = 3
+
+
+def write_screenshot(filepath, data, original_ext):
+    """Downscale and compress screenshot bytes to WebP at filepath (runs in the background)"""
+    try:
+        # Downscale and compress - raw PNG screenshots are often 10x larger
+        with Image.open(io.BytesIO(data)) as img:
+            img.thumbnail(SCREENSHOT_MAX_SIZE, Image.Resampling.LANCZOS)
+            if img.mode not in ('RGB', 'RGBA'):
+                img = img.convert('RGBA')
+            img.save(filepath, 'WEBP', quality=SCREENSHOT_WEBP_QUALITY, method=4)
+    except Exception:
+        # Keep the upload as it came in, under its own extension, rather than leaving the
+        # record with a dangling path; uploaded_file serves it in place of the WebP.
+        # (The folder may also have been removed - recreate it next time)
+        fallback_path = filepath.with_suffix(f'.{original_ext}')
+        logger.exception("Could not compress screenshot %s, storing the original as %s",
+                         filepath, fallback_path.name)
+        ensure_upload_dir.cache_clear()
+        try:
+            fallback_path.parent.mkdir(parents=True, exist_ok=True)
+            fallback_path.write_bytes(data)
+        except OSError:
+            logger.exception("Could not save screenshot %s", fallback_path)
 
 
 def save_screenshot(file):
-    """Save uploaded screenshot and return filename"""
+    """Save uploaded screenshot (compressed to WebP) and return filename"""
     if file and allowed_file(file.filename):
-        # Generate unique filename
-        ext = file.filename.rsplit('.', 1)[1].lower()
-        filename = f"{uuid.uuid4().hex}.{ext}"
+        # Screenshots are stored as WebP regardless of the uploaded format
+        filename = f"{secrets.token_hex(16)}.webp"
         
         # Create date-based folder
         today = get_local_time().strftime("%Y-%m-%d")
-        folder = Path(app.config['UPLOAD_FOLDER']) / today
-        folder.mkdir(parents=True, exist_ok=True)
+        folder = ensure_upload_dir(today)
         
-        # Save file
-        filepath = folder / filename
-        file.save(str(filepath))
+        # Uploads are capped by MAX_CONTENT_LENGTH, so the bytes can be handed to the
+        # background writer. Opening the image only parses its header - enough to
+        # reject files that aren't images before the record is saved
+        data = file.stream.read()
+        try:
+            with Image.open(io.BytesIO(data)):
+                pass
+        except (OSError, Image.DecompressionBombError):
+            return None
         
-        return f"{today}/{filename}"
+        relative_path = f"{today}/{filename}"
+        original_ext = file.filename.rpartition('.')[2].lower()
+        try:
+            future = _screenshot_executor.submit(write_screenshot, folder / filename, data, original_ext)
+        except RuntimeError:
+            # Executor already shut down (worker exiting) - write it in the request instead
+            write_screenshot(folder / filename, data, original_ext)
+        else:
+            _pending_screenshots[relative_path] = future
+            future.add_done_callback(lambda _: _pending_screenshots.pop(relative_path, None))
+        return relative_path
     return None
 
 
+def stored_screenshot_path(upload_folder, relative_path):
+    """Path a screenshot was actually stored under: the WebP, or the original upload
+    when compressing it failed (see write_screenshot). None if neither exists."""
+    if os.path.isfile(upload_folder / relative_path):
+        return relative_path
+    stem, _, ext = relative_path.rpartition('.')
+    if ext == 'webp':
+        for original_ext in ALLOWED_EXTENSIONS:
+            if os.path.isfile(upload_folder / f"{stem}.{original_ext}"):
+                return f"{stem}.{original_ext}"
+    return None
+
+
+def wait_for_screenshot(upload_folder, relative_path):
+    """Stored path of a screenshot, waiting briefly if it may still be being written.
+    The dashboard asks for thumbnails right after the record is created."""
+    stored_path = stored_screenshot_path(upload_folder, relative_path)
+    if stored_path is not None:
+        return stored_path
+    
+    future = _pending_screenshots.get(relative_path)
+    if future is not None:
+        wait_for_futures([future], timeout=SCREENSHOT_WRITE_WAIT_SECONDS)
+        return stored_screenshot_path(upload_folder, relative_path)
+    
+    # Uploaded today - another worker may still be writing it
+    if relative_path.startswith(get_local_time().strftime('%Y-%m-%d/')):
+        deadline = monotonic() + SCREENSHOT_WRITE_WAIT_SECONDS
+        while stored_path is None and monotonic() < deadline:
+            sleep(0.1)
+            stored_path = stored_screenshot_path(upload_folder, relative_path)
+    return stored_path
+
+
+# Old records store bare screenshot filenames, which have to be found in one of the
+# date folders. Keep a filename -> relative path index instead of scanning every
+# folder per request; a miss rescans at most once per interval and replaces the
+# whole index. New uploads are stored with their date folder, so they are not added
+UPLOAD_INDEX_RESCAN_SECONDS = 60
+_upload_index = {'paths': {}, 'rescan_after': 0.0}
+
+
+def find_legacy_upload(upload_folder, filename):
+    """Return the date-folder relative path of a bare screenshot filename, or None"""
+    index = _upload_index
+    relative_path = index['paths'].get(filename)
+    if relative_path is None and monotonic() >= index['rescan_after']:
+        paths = {}
+        for date_folder in upload_folder.iterdir():
+            if date_folder.is_dir():
+                for entry in date_folder.iterdir():
+                    paths.setdefault(entry.name, f"{date_folder.name}/{entry.name}")
+        index['paths'] = paths
+        index['rescan_after'] = monotonic() + UPLOAD_INDEX_RESCAN_SECONDS
+        relative_path = paths.get(filename)
+    if relative_path is not None and not os.path.isfile(upload_folder / relative_path):
+        # Removed since it was indexed
+        index['paths'].pop(filename, None)
+        return None
+    return relative_path
+
+
 def init_db():
     """Initialize database and create default users"""
     db.create_all()
@@ -280,9 +640,36 @@ def init_db():
         print(f"Note: Could not check/migrate Shift table schema: {e}")
         # Continue anyway - db.create_all() will handle new columns
     
-    # Create default users if they don't exist
-    for user_data in DEFAULT_USERS:
-        if not User.query.filter_by(username=user_data['username']).first():
+    # Add updated_at (used to fingerprint /api/breaks responses) to tables created before it
+    try:
+        from sqlalchemy import inspect, text
+        inspector = inspect(db.engine)
+        with db.engine.connect() as conn:
+            for table in ('break_record', 'shift'):
+                if 'updated_at' not in [col['name'] for col in inspector.get_columns(table)]:
+                    print(f"Migrating {table} table: Adding updated_at column...")
+                    conn.execute(text(f"ALTER TABLE {table} ADD COLUMN updated_at TIMESTAMP"))
+                    conn.execute(text(f"UPDATE {table} SET updated_at = created_at"))
+            conn.commit()
+    except Exception as e:
+        print(f"Note: Could not add updated_at columns: {e}")
+    
+    # db.create_all() only creates indexes together with a new table,
+    # so add any indexes that are missing from tables created before them
+    try:
+        for table in db.metadata.sorted_tables:
+            for index in table.indexes:
+                index.create(bind=db.engine, checkfirst=True)
+    except Exception as e:
+        print(f"Note: Could not create missing indexes: {e}")
+    
+    # Create default users if they don't exist (one query for all existing usernames)
+    default_users = get_default_users()
+    existing_usernames = set(db.session.scalars(db.select(User.username).where(
+        User.username.in_([user_data['username'] for user_data in default_users])
+    )))
+    for user_data in default_users:
+        if user_data['username'] not in existing_usernames:
             user = User(
                 username=user_data['username'],
                 full_name=user_data['full_name'],
@@ -306,6 +693,44 @@ def index():
     return redirect(url_for('login'))
 
 
+# Failed login counts per (client address, username): {key: (failures, window_ends_at)}.
+# Keyed by address too, so nobody can lock a user out for everyone else
+_login_failures = {}
+_login_failures_lock = threading.Lock()
+
+
+def login_attempt_key(username):
+    """Failed-login counter key for this request's client and the submitted username"""
+    return (request.remote_addr, username)
+
+
+def login_locked_out(key):
+    """True if key has used up its failed logins for the current window"""
+    with _login_failures_lock:
+        entry = _login_failures.get(key)
+    return entry is not None and entry[0] >= LOGIN_MAX_FAILURES and monotonic() < entry[1]
+
+
+def record_login_failure(key):
+    """Count a failed login; the window starts at the first failure"""
+    now = monotonic()
+    with _login_failures_lock:
+        failures, window_ends_at = _login_failures.get(key, (0, 0.0))
+        if now >= window_ends_at:
+            failures, window_ends_at = 0, now + LOGIN_FAILURE_WINDOW_SECONDS
+        _login_failures[key] = (failures + 1, window_ends_at)
+        # Attempts against made-up usernames would otherwise grow this forever
+        if len(_login_failures) > 10000:
+            for stale_key in [k for k, (_, ends_at) in _login_failures.items() if now >= ends_at]:
+                del _login_failures[stale_key]
+
+
+def clear_login_failures(key):
+    """Forget failed logins for key after a successful one"""
+    with _login_failures_lock:
+        _login_failures.pop(key, None)
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     """Login page"""
@@ -316,13 +741,25 @@ def login():
         username = request.form.get('username', '').strip()
         password = request.form.get('password', '')
         
+        # Refuse before the bcrypt check, so guessing costs no hashing time either
+        attempt_key = login_attempt_key(username)
+        if login_locked_out(attempt_key):
+            flash('Too many failed login attempts. Please try again in a few minutes.', 'error')
+            return render_template('login.html'), 429
+        
         user = User.query.filter_by(username=username).first()
         
         if user and user.check_password(password):
+            clear_login_failures(attempt_key)
+            # Re-hash passwords stored with an older cost while the plaintext is at hand
+            if user.password_needs_rehash():
+                user.set_password(password)
+                db.session.commit()
             login_user(user)
             flash('Logged in successfully!', 'success')
             return redirect(url_for('index'))
         else:
+            record_login_failure(attempt_key)
             flash('Invalid username or password', 'error')
     
     return render_template('login.html')
@@ -345,18 +782,17 @@ def agent_view():
         return redirect(url_for('dashboard'))
     
     # Get active break for this agent (exclude punch_in/punch_out as they're auto-completed)
-    # Use a more compatible query method
-    all_active = BreakRecord.query.filter(
+    active_break = BreakRecord.query.filter(
         BreakRecord.agent_id == current_user.id,
-        BreakRecord.end_time == None
-    ).all()
-    active_break = next((b for b in all_active if b.break_type not in ['punch_in', 'punch_out']), None)
+        BreakRecord.end_time == None,
+        ~BreakRecord.break_type.in_(PUNCH_TYPES)
+    ).first()
     
     # Get today's breaks
     today = get_local_time().date()
-    today_breaks = BreakRecord.query.filter(
+    today_breaks = BreakRecord.query.options(*LISTING_QUERY_OPTIONS).filter(
         BreakRecord.agent_id == current_user.id,
-        db.func.date(BreakRecord.start_time) == today
+        started_on(today)
     ).order_by(BreakRecord.start_time.desc()).all()
     
     # Get today's shift for this agent (shift that starts today or includes today)
@@ -410,7 +846,7 @@ def agent_view():
             punch_out_today = BreakRecord.query.filter(
                 BreakRecord.agent_id == current_user.id,
                 BreakRecord.break_type == 'punch_out',
-                db.func.date(BreakRecord.start_time) == today
+                started_on(today)
             ).first()
             if punch_out_today:
                 punch_status = 'punched_out'
@@ -425,13 +861,13 @@ def agent_view():
     punch_in_today = BreakRecord.query.filter(
         BreakRecord.agent_id == current_user.id,
         BreakRecord.break_type == 'punch_in',
-        db.func.date(BreakRecord.start_time) == today
+        started_on(today)
     ).first()
     
     punch_out_today = BreakRecord.query.filter(
         BreakRecord.agent_id == current_user.id,
         BreakRecord.break_type == 'punch_out',
-        db.func.date(BreakRecord.start_time) == today
+        started_on(today)
     ).first()
     
     return render_template('agent.html',
@@ -444,9 +880,7 @@ def agent_view():
         is_off_day=is_off_day,
         punch_status=punch_status,
         punch_in_time=punch_in_today.start_time if punch_in_today else (punch_in.start_time if punch_in else None),
-        punch_out_time=punch_out_today.start_time if punch_out_today else None,
-        break_types=BREAK_INFO,
-        break_durations=BREAK_DURATIONS
+        punch_out_time=punch_out_today.start_time if punch_out_today else None
     )
 
 
@@ -463,24 +897,11 @@ def dashboard():
     type_filter = request.args.get('type', '')
     
     # Get all agents
-    agents = User.query.filter_by(role=ROLE_AGENT).order_by(User.full_name).all()
+    agents = get_agent_roster()
     
     # Get stats (exclude punch_in/punch_out as they're attendance records, not breaks)
     today = get_local_time().date()
-    total_breaks_today = BreakRecord.query.filter(
-        db.func.date(BreakRecord.start_time) == today,
-        ~BreakRecord.break_type.in_(['punch_in', 'punch_out'])
-    ).count()
-    
-    # Active breaks (exclude punch_in/punch_out)
-    all_active = BreakRecord.query.filter_by(end_time=None).all()
-    active_breaks = len([b for b in all_active if b.break_type not in ['punch_in', 'punch_out']])
-    
-    overdue_breaks = BreakRecord.query.filter(
-        db.func.date(BreakRecord.start_time) == today,
-        BreakRecord.is_overdue == True,
-        ~BreakRecord.break_type.in_(['punch_in', 'punch_out'])
-    ).count()
+    total_breaks_today, active_breaks, overdue_breaks = get_break_counters(today)
     
     return render_template('dashboard.html',
         user=current_user,
@@ -489,8 +910,6 @@ def dashboard():
         total_breaks_today=total_breaks_today,
         active_breaks=active_breaks,
         overdue_breaks=overdue_breaks,
-        break_types=BREAK_INFO,
-        break_durations=BREAK_DURATIONS,
         date_filter=date_filter,
         agent_filter=agent_filter,
         type_filter=type_filter
@@ -517,28 +936,25 @@ def get_breaks():
         # IMPORTANT: Filter by shift start date, not break date
         # If filtering for Dec 30, show all records from shifts that STARTED on Dec 30
         # This includes breaks/punches that happened on Dec 31 if the shift started Dec 30
-        extended_start_date = (datetime.strptime(start_date, '%Y-%m-%d').date() - timedelta(days=1)).strftime('%Y-%m-%d')
-        extended_end_date = (datetime.strptime(end_date, '%Y-%m-%d').date() + timedelta(days=1)).strftime('%Y-%m-%d')
-        
-        # Get all shifts that START on the requested date range
-        # Wrap in try/except in case database schema hasn't been updated
+        # Parse the range once; everything below compares date objects
         try:
-            shifts_in_range = Shift.query.filter(
-                Shift.start_date >= start_date,
-                Shift.start_date <= end_date
-            ).all()
-        except Exception as shift_error:
-            # If start_date column doesn't exist, return empty list
-            print(f"Warning: Could not query shifts by start_date: {shift_error}")
-            shifts_in_range = []
+            start_day = date.fromisoformat(start_date)
+            end_day = date.fromisoformat(end_date)
+        except ValueError:
+            return jsonify({'error': 'Invalid date format'}), 400
+        extended_start_date = start_day - timedelta(days=1)
+        extended_end_date = end_day + timedelta(days=1)
         
-        # Get agent IDs from shifts in range
-        agent_ids_in_range = {s.agent_id for s in shifts_in_range}
+        # Dashboard polls this endpoint; skip rebuilding the response if nothing changed
+        etag = breaks_etag(extended_start_date, extended_end_date)
+        if request.if_none_match.contains(etag):
+            response = Response(status=304)
+            response.set_etag(etag)
+            return response
         
         # Query breaks - extend range to catch overnight shifts
-        query = BreakRecord.query.filter(
-            db.func.date(BreakRecord.start_time) >= extended_start_date,
-            db.func.date(BreakRecord.start_time) <= extended_end_date
+        query = BreakRecord.query.options(*LISTING_QUERY_OPTIONS).filter(
+            started_on(extended_start_date, extended_end_date)
         )
         
         if agent_id:
@@ -547,71 +963,63 @@ def get_breaks():
         if break_type:
             query = query.filter_by(break_type=break_type)
         
-        breaks = query.order_by(BreakRecord.start_time.desc()).all()
-        
-        # Separate attendance records (punch_in/punch_out) from breaks
-        attendance_records = [br for br in breaks if br.break_type in ['punch_in', 'punch_out']]
-        regular_breaks = [br for br in breaks if br.break_type not in ['punch_in', 'punch_out']]
+        # Separate attendance records (punch_in/punch_out) from breaks in a single pass,
+        # streaming rows in batches (server-side cursor on Postgres) instead of
+        # materializing the combined result first
+        attendance_records = []
+        regular_breaks = []
+        for br in query.order_by(BreakRecord.start_time.desc()).yield_per(500):
+            if br.break_type in PUNCH_TYPES:
+                attendance_records.append(br)
+            else:
+                regular_breaks.append(br)
         
         # For attendance records, also fetch punch outs that pair with punch ins in the date range
         # This handles cases where punch in is on day 1 and punch out is on day 2
         # This works for both regular breaks and manually created breaks
-        if attendance_records:
-            # Find punch outs that might be paired with punch ins in the date range
-            # Look for punch outs within 2 days after each punch in (to handle overnight shifts)
-            extended_attendance = list(attendance_records)
+        punch_times = [br.start_time for br in attendance_records if br.start_time]
+        if punch_times:
+            # Fetch every punch for these agents within 2 days either side of the range
+            # in one query, then keep the ones that pair with an in-range punch
+            candidates = BreakRecord.query.options(*LISTING_QUERY_OPTIONS).filter(
+                BreakRecord.agent_id.in_({br.agent_id for br in attendance_records}),
+                BreakRecord.break_type.in_(PUNCH_TYPES),
+                BreakRecord.start_time >= min(punch_times) - timedelta(days=2),
+                BreakRecord.start_time <= max(punch_times) + timedelta(days=2)
+            ).order_by(BreakRecord.start_time).all()
             
-            for punch_in in attendance_records:
-                if punch_in.break_type == 'punch_in' and punch_in.start_time:
-                    # Look for punch out within next 2 days (to handle overnight shifts)
-                    punch_in_time = punch_in.start_time
-                    max_punch_out_time = punch_in_time + timedelta(days=2)
-                    
-                    # Query for matching punch out (same agent, after punch in, within 2 days)
-                    punch_out_query = BreakRecord.query.filter(
-                        BreakRecord.agent_id == punch_in.agent_id,
-                        BreakRecord.break_type == 'punch_out',
-                        BreakRecord.start_time > punch_in_time,
-                        BreakRecord.start_time <= max_punch_out_time
-                    )
-                    
-                    if agent_id:
-                        punch_out_query = punch_out_query.filter_by(agent_id=int(agent_id))
-                    
-                    matching_punch_outs = punch_out_query.all()
-                    
-                    # Add punch outs that aren't already in the list
-                    for po in matching_punch_outs:
-                        if po not in extended_attendance:
-                            extended_attendance.append(po)
+            # Sorted times of the in-range punch ins and punch outs per agent
+            punch_in_times = {}
+            punch_out_times = {}
+            for br in attendance_records:
+                if br.start_time:
+                    times = punch_in_times if br.break_type == 'punch_in' else punch_out_times
+                    times.setdefault(br.agent_id, []).append(br.start_time)
+            for times in (*punch_in_times.values(), *punch_out_times.values()):
+                times.sort()
             
-            # Also find punch ins that pair with punch outs in the date range
-            # (in case punch out was created first or manually added)
-            for punch_out in attendance_records:
-                if punch_out.break_type == 'punch_out' and punch_out.start_time:
-                    # Look for punch in within 2 days before this punch out
-                    punch_out_time = punch_out.start_time
-                    min_punch_in_time = punch_out_time - timedelta(days=2)
-                    
-                    # Query for matching punch in (same agent, before punch out, within 2 days)
-                    punch_in_query = BreakRecord.query.filter(
-                        BreakRecord.agent_id == punch_out.agent_id,
-                        BreakRecord.break_type == 'punch_in',
-                        BreakRecord.start_time >= min_punch_in_time,
-                        BreakRecord.start_time < punch_out_time
-                    )
-                    
-                    if agent_id:
-                        punch_in_query = punch_in_query.filter_by(agent_id=int(agent_id))
-                    
-                    matching_punch_ins = punch_in_query.all()
-                    
-                    # Add punch ins that aren't already in the list
-                    for pi in matching_punch_ins:
-                        if pi not in extended_attendance:
-                            extended_attendance.append(pi)
+            existing = set(attendance_records)
+            extra_punch_outs = []
+            extra_punch_ins = []
+            for candidate in candidates:
+                if candidate in existing:
+                    continue
+                if candidate.break_type == 'punch_out':
+                    # Punch out within 2 days after a punch in in the date range
+                    # (punch in on day 1 and punch out on day 2)
+                    times = punch_in_times.get(candidate.agent_id, [])
+                    idx = bisect_left(times, candidate.start_time) - 1
+                    if idx >= 0 and times[idx] >= candidate.start_time - timedelta(days=2):
+                        extra_punch_outs.append(candidate)
+                else:
+                    # Punch in within 2 days before a punch out in the date range
+                    # (in case punch out was created first or manually added)
+                    times = punch_out_times.get(candidate.agent_id, [])
+                    idx = bisect_right(times, candidate.start_time)
+                    if idx < len(times) and times[idx] <= candidate.start_time + timedelta(days=2):
+                        extra_punch_ins.append(candidate)
             
-            attendance_records = extended_attendance
+            attendance_records = attendance_records + extra_punch_outs + extra_punch_ins
         
         # Group breaks by shift period (not just calendar date)
         # For overnight shifts (e.g., 4pm-1am), breaks after midnight belong to the shift that started the previous day
@@ -649,15 +1057,40 @@ def get_breaks():
                 print(f"Warning: Could not query shifts - schema may need migration: {e}")
                 all_shifts = []
         
-        # Create a mapping: agent_id -> list of shifts
+        # Create a mapping: agent_id -> list of shifts, sorted by start date so the
+        # shifts covering a day can be found by binary search on the start dates
         shifts_by_agent = {}
-        for shift in all_shifts:
+        for shift in sorted(all_shifts, key=lambda s: s.start_date):
             if shift.agent_id not in shifts_by_agent:
                 shifts_by_agent[shift.agent_id] = []
             shifts_by_agent[shift.agent_id].append(shift)
+        shift_starts_by_agent = {aid: [s.start_date for s in agent_shifts]
+                                 for aid, agent_shifts in shifts_by_agent.items()}
+        
+        def shifts_covering(agent_id, day):
+            """Yield the agent's shifts whose date range includes day, latest start first"""
+            agent_shifts = shifts_by_agent.get(agent_id, [])
+            # Only shifts starting on or before day can cover it
+            for i in range(bisect_right(shift_starts_by_agent.get(agent_id, []), day) - 1, -1, -1):
+                if agent_shifts[i].end_date >= day:
+                    yield agent_shifts[i]
+        
+        # Prefetch punch in times for every agent with breaks in one query, covering the
+        # 24 hours before the earliest break, instead of one lookup per break
+        punch_in_times_by_agent = {}
+        break_times = [br.start_time for br in regular_breaks if br.start_time]
+        if break_times:
+            punch_in_rows = db.session.query(BreakRecord.agent_id, BreakRecord.start_time).filter(
+                BreakRecord.agent_id.in_({br.agent_id for br in regular_breaks}),
+                BreakRecord.break_type == 'punch_in',
+                BreakRecord.start_time >= min(break_times) - timedelta(hours=24),
+                BreakRecord.start_time <= max(break_times)
+            ).order_by(BreakRecord.start_time).all()
+            for row_agent_id, punch_in_time in punch_in_rows:
+                punch_in_times_by_agent.setdefault(row_agent_id, []).append(punch_in_time)
         
         # Function to find which shift a break belongs to (based on punch in time or shift time)
-        def find_shift_for_break(break_record, agent_shifts):
+        def find_shift_for_break(break_record):
             """Find the shift that a break belongs to"""
             if not break_record.start_time:
                 return None
@@ -665,66 +1098,69 @@ def get_breaks():
             break_time = break_record.start_time
             
             # First, try to find punch in for this agent before this break (within last 24 hours)
-            punch_in = BreakRecord.query.filter(
-                BreakRecord.agent_id == break_record.agent_id,
-                BreakRecord.break_type == 'punch_in',
-                BreakRecord.start_time <= break_time,
-                BreakRecord.start_time >= break_time - timedelta(hours=24)
-            ).order_by(BreakRecord.start_time.desc()).first()
+            # Latest punch in at or before the break, found by binary search on the sorted times
+            punch_in_times = punch_in_times_by_agent.get(break_record.agent_id, [])
+            idx = bisect_right(punch_in_times, break_time) - 1
+            punch_in_time = punch_in_times[idx] if idx >= 0 else None
             
-            if punch_in and punch_in.start_time:
+            if punch_in_time and punch_in_time >= break_time - timedelta(hours=24):
                 # Find shift that matches this punch in date
-                punch_in_date = punch_in.start_time.date()
-                for shift in agent_shifts:
-                    if shift.start_date <= punch_in_date <= shift.end_date:
-                        return shift
+                punch_in_date = punch_in_time.date()
+                for shift in shifts_covering(break_record.agent_id, punch_in_date):
+                    return shift
             
             # If no punch in found, try to match by break time and shift date range
             # For overnight shifts, break might be on next day but belong to previous day's shift
             break_date = break_time.date()
             
-            for shift in agent_shifts:
-                # Check if break date falls within shift date range
-                if shift.start_date <= break_date <= shift.end_date:
-                    # Check if break time is within reasonable range (within 24 hours of shift start)
-                    shift_start_datetime = datetime.combine(shift.start_date, shift.start_time)
-                    time_diff = (break_time - shift_start_datetime).total_seconds() / 3600  # hours
-                    if 0 <= time_diff <= 24:  # Within 24 hours of shift start
-                        return shift
+            # Check shifts whose date range includes the break date
+            for shift in shifts_covering(break_record.agent_id, break_date):
+                # Check if break time is within reasonable range (within 24 hours of shift start)
+                shift_start_datetime = datetime.combine(shift.start_date, shift.start_time)
+                time_diff = (break_time - shift_start_datetime).total_seconds() / 3600  # hours
+                if 0 <= time_diff <= 24:  # Within 24 hours of shift start
+                    return shift
             
             return None
         
         # Group breaks by agent and shift period
         # KEY CHANGE: Only show breaks that belong to shifts that STARTED in the requested date range
+        now = get_local_time().replace(tzinfo=None)
+        
+        # Agent names for every record, fetched in one query instead of through each row's agent
+        agent_names = dict(db.session.query(User.id, User.full_name).filter(
+            User.id.in_({br.agent_id for br in regular_breaks} | {br.agent_id for br in attendance_records})
+        ).all())
+        
         agents_data = {}
         for br in regular_breaks:
             # Find the shift this break belongs to
-            agent_shifts = shifts_by_agent.get(br.agent_id, [])
-            shift = find_shift_for_break(br, agent_shifts)
+            shift = find_shift_for_break(br)
             
             # Filter: Only include if shift started in the requested date range
             if shift:
-                shift_start_date_str = shift.start_date.strftime('%Y-%m-%d')
                 # Only include breaks from shifts that STARTED in the date range
-                if shift_start_date_str < start_date or shift_start_date_str > end_date:
+                if not start_day <= shift.start_date <= end_day:
                     continue  # Skip - shift didn't start in the requested date range
             else:
                 # No shift found - only include if break date is in range (fallback)
                 break_date = br.start_time.date() if br.start_time else None
                 if break_date:
-                    break_date_str = break_date.strftime('%Y-%m-%d')
-                    if break_date_str < start_date or break_date_str > end_date:
+                    if not start_day <= break_date <= end_day:
                         continue  # Skip - break date outside range and no shift
             
-            if br.agent_id not in agents_data:
-                agents_data[br.agent_id] = {
-                    'agent_name': br.agent.full_name,
+            # One lookup per row; agents keep first-seen (latest break first) order for the dashboard
+            agent_name = agent_names.get(br.agent_id, 'Unknown')
+            agent_data = agents_data.get(br.agent_id)
+            if agent_data is None:
+                agent_data = agents_data[br.agent_id] = {
+                    'agent_name': agent_name,
                     'breaks': [],
                     'attendance': []
                 }
             
             # Add shift date info to break dict for grouping
-            break_dict = br.to_dict()
+            break_dict = br.to_dict(now, agent_name)
             if shift:
                 # Use shift start date as the grouping key (even if break is on next day)
                 break_dict['shift_date'] = shift.start_date.isoformat()
@@ -732,7 +1168,7 @@ def get_breaks():
                 # No shift found, use break's calendar date
                 break_dict['shift_date'] = br.start_time.date().isoformat() if br.start_time else None
             
-            agents_data[br.agent_id]['breaks'].append(break_dict)
+            agent_data['breaks'].append(break_dict)
         
         # Group attendance records by agent and pair punch in/out together
         # NEW LOGIC: Punch in and punch out are always paired and shown together
@@ -741,83 +1177,60 @@ def get_breaks():
         
         # First, pair all punch in/out records by agent
         # Key: (agent_id, punch_in_id) -> (punch_in, punch_out)
-        punch_pairs = {}
-        standalone_punch_outs = []
-        
-        for br in attendance_records:
+        # A punch in pairs with the punch out after it that has no other punch in in between;
+        # when several qualify, the one listed first in attendance_records wins.
+        # Punch times are laid out per agent in sorted lists so each pair is found by
+        # binary search instead of rescanning every record for every punch in
+        pair_in_times = {}
+        pair_outs_by_agent = {}
+        for position, br in enumerate(attendance_records):
             if not br.start_time:
                 continue
-            
             if br.break_type == 'punch_in':
-                # Find matching punch out (next punch out after this punch in)
-                punch_out = None
-                for br2 in attendance_records:
-                    if (br2.break_type == 'punch_out' and 
-                        br2.agent_id == br.agent_id and 
-                        br2.start_time and 
-                        br2.start_time > br.start_time):
-                        # Check if there's no other punch in between
-                        has_punch_in_between = False
-                        for br3 in attendance_records:
-                            if (br3.break_type == 'punch_in' and 
-                                br3.agent_id == br.agent_id and 
-                                br3.start_time and
-                                br.start_time < br3.start_time < br2.start_time):
-                                has_punch_in_between = True
-                                break
-                        if not has_punch_in_between:
-                            punch_out = br2
-                            break
-                
-                # Store the pair
-                pair_key = (br.agent_id, br.id)
-                punch_pairs[pair_key] = {
-                    'punch_in': br,
-                    'punch_out': punch_out,
-                    'display_date': None  # Will be determined based on shift
-                }
+                pair_in_times.setdefault(br.agent_id, []).append(br.start_time)
             elif br.break_type == 'punch_out':
-                # Check if this punch out is already paired with a punch in
-                is_paired = False
-                for pair_key, pair_data in punch_pairs.items():
-                    if pair_data['punch_out'] and pair_data['punch_out'].id == br.id:
-                        is_paired = True
-                        break
-                if not is_paired:
-                    # Standalone punch out (shouldn't happen, but handle it)
-                    standalone_punch_outs.append(br)
+                pair_outs_by_agent.setdefault(br.agent_id, []).append((br.start_time, position, br))
+        for times in pair_in_times.values():
+            times.sort()
+        pair_out_times = {}
+        for agent_id, punch_outs in pair_outs_by_agent.items():
+            punch_outs.sort(key=lambda entry: entry[0])
+            pair_out_times[agent_id] = [entry[0] for entry in punch_outs]
+        
+        punch_pairs = {}
+        for br in attendance_records:
+            if not br.start_time or br.break_type != 'punch_in':
+                continue
+            
+            # Candidate punch outs are after this punch in and no later than the next punch in
+            in_times = pair_in_times[br.agent_id]
+            out_times = pair_out_times.get(br.agent_id, [])
+            next_in = bisect_right(in_times, br.start_time)
+            lo = bisect_right(out_times, br.start_time)
+            hi = bisect_right(out_times, in_times[next_in]) if next_in < len(in_times) else len(out_times)
+            pair_candidates = pair_outs_by_agent[br.agent_id][lo:hi] if lo < hi else ()
+            punch_out = min(pair_candidates, key=lambda entry: entry[1])[2] if pair_candidates else None
+            
+            # Store the pair
+            pair_key = (br.agent_id, br.id)
+            punch_pairs[pair_key] = {
+                'punch_in': br,
+                'punch_out': punch_out,
+                'display_date': None  # Will be determined based on shift
+            }
         
         # Determine display date for each pair
         # Logic: Show on shift start day ONLY if punch in happened on shift start day
         # If punch in happened on a later day, show on the punch in day (it's a new shift or continuation)
+        # Both cases resolve to the punch in day, so no shift lookup is needed.
+        # This prevents Jan 2 punch in from showing on Jan 1
         for pair_key, pair_data in punch_pairs.items():
-            punch_in = pair_data['punch_in']
-            punch_in_date = punch_in.start_time.date()
-            
-            # Find the shift this punch in belongs to
-            agent_shifts = shifts_by_agent.get(punch_in.agent_id, [])
-            shift = None
-            for s in agent_shifts:
-                if s.start_date <= punch_in_date <= s.end_date:
-                    shift = s
-                    break
-            
-            # Display date logic:
-            # - If punch in happened on shift start day, show on shift start day
-            # - If punch in happened on a later day (even if same shift), show on punch in day
-            # This prevents Jan 2 punch in from showing on Jan 1
-            if shift and punch_in_date == shift.start_date:
-                # Punch in on shift start day - show on shift start day
-                pair_data['display_date'] = shift.start_date
-            else:
-                # Punch in on a later day - show on the day it happened
-                pair_data['display_date'] = punch_in_date
+            pair_data['display_date'] = pair_data['punch_in'].start_time.date()
         
         # Filter pairs to include only those whose display_date is in the requested range
         filtered_attendance = []
         for pair_key, pair_data in punch_pairs.items():
-            display_date_str = pair_data['display_date'].strftime('%Y-%m-%d')
-            if display_date_str >= start_date and display_date_str <= end_date:
+            if start_day <= pair_data['display_date'] <= end_day:
                 # Include both punch in and punch out (if exists) as a pair
                 filtered_attendance.append(pair_data['punch_in'])
                 if pair_data['punch_out']:
@@ -837,76 +1250,74 @@ def get_breaks():
                 agent_attendance[br.agent_id] = []
             agent_attendance[br.agent_id].append(br)
         
+        def punch_dict(record):
+            """One side of a punch pair; the date is sliced from the ISO time rather than formatted again"""
+            time_iso = record.start_time.isoformat() if record.start_time else None
+            return {
+                'id': record.id,
+                'time': time_iso,
+                'screenshot': record.start_screenshot or record.end_screenshot,
+                'date': time_iso[:10] if time_iso else None
+            }
+        
+        def punch_pair_dict(punch_in, punch_out):
+            """Combined attendance record for a punch in and its punch out (or None)"""
+            return {
+                'id': punch_in.id,
+                'type': 'punch_pair',
+                'punch_in': punch_dict(punch_in),
+                'punch_out': punch_dict(punch_out) if punch_out else None,
+                'notes': punch_in.notes or ''
+            }
+        
         # Pair punch in with punch out for each agent
         # IMPORTANT: Initialize agents_data for agents that only have punches (no breaks)
         for agent_id, records in agent_attendance.items():
             if agent_id not in agents_data:
-                # Get agent name from first record
-                agent_name = records[0].agent.full_name if records else 'Unknown'
                 agents_data[agent_id] = {
-                    'agent_name': agent_name,
+                    'agent_name': agent_names.get(agent_id, 'Unknown'),
                     'breaks': [],
                     'attendance': []
                 }
             
-            # Pair punch in with the next punch out
+            # Pair punch in with the next punch out in one pass over the time-sorted records
             # Records are already filtered to show pairs together on the same day
-            i = 0
-            while i < len(records):
-                current = records[i]
+            # A punch in followed by another punch in is emitted unpaired; a punch out
+            # with no pending punch in is standalone and skipped (shouldn't happen with new logic)
+            attendance = agents_data[agent_id]['attendance']
+            pending = None
+            for current in records:
                 if current.break_type == 'punch_in':
-                    # Look for the next punch out (should be in the same filtered list)
-                    punch_out = None
-                    for j in range(i + 1, len(records)):
-                        if records[j].break_type == 'punch_out':
-                            # Verify this punch out belongs to this punch in
-                            # (no other punch in between them)
-                            has_punch_in_between = False
-                            for k in range(i + 1, j):
-                                if records[k].break_type == 'punch_in':
-                                    has_punch_in_between = True
-                                    break
-                            if not has_punch_in_between:
-                                punch_out = records[j]
-                                i = j + 1  # Skip the punch out in next iteration
-                                break
-                    
-                    # Create combined attendance record
-                    agents_data[agent_id]['attendance'].append({
-                        'id': current.id,
-                        'type': 'punch_pair',
-                        'punch_in': {
-                            'id': current.id,
-                            'time': current.start_time.isoformat() if current.start_time else None,
-                            'screenshot': current.start_screenshot or current.end_screenshot,
-                            'date': current.start_time.date().isoformat() if current.start_time else None
-                        },
-                        'punch_out': {
-                            'id': punch_out.id if punch_out else None,
-                            'time': punch_out.start_time.isoformat() if punch_out and punch_out.start_time else None,
-                            'screenshot': (punch_out.start_screenshot or punch_out.end_screenshot) if punch_out else None,
-                            'date': punch_out.start_time.date().isoformat() if punch_out and punch_out.start_time else None
-                        } if punch_out else None,
-                        'notes': current.notes or ''
-                    })
-                    
-                    if not punch_out:
-                        i += 1  # No punch out found, move to next
-                else:
-                    # Standalone punch out - this shouldn't happen with new logic
-                    # But if it does, skip it (punch out should always be with punch in)
-                    i += 1
-        
-        return jsonify({
-            'agents': list(agents_data.values()),
-            'total_breaks': len(regular_breaks)  # Only count regular breaks
-        })
+                    if pending:
+                        attendance.append(punch_pair_dict(pending, None))
+                    pending = current
+                elif pending:
+                    attendance.append(punch_pair_dict(pending, current))
+                    pending = None
+            if pending:
+                attendance.append(punch_pair_dict(pending, None))
+        
+        # Stream the payload one agent at a time so a wide date range never holds
+        # the whole serialized response in memory at once
+        total_breaks = len(regular_breaks)  # Only count regular breaks
+        
+        def generate():
+            yield b'{"agents":['
+            for n, agent_data in enumerate(agents_data.values()):
+                if n:
+                    yield b','
+                yield orjson.dumps(agent_data)
+            yield b'],"total_breaks":%d}' % total_breaks
+        
+        response = Response(generate(), mimetype='application/json')
+        # no-cache makes the browser revalidate with If-None-Match on every poll
+        response.set_etag(etag)
+        response.cache_control.no_cache = True
+        response.cache_control.private = True
+        return response
     except Exception as e:
         # Log the error for debugging
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error in get_breaks: {e}")
-        print(error_trace)
+        logger.exception("Error in get_breaks")
         # Return a proper JSON error response
         return jsonify({
             'error': f'Failed to load breaks: {str(e)}',
@@ -922,11 +1333,11 @@ def start_break():
         return jsonify({'error': 'RTM cannot take breaks'}), 403
     
     # Check for active break (exclude punch_in/punch_out as they're auto-completed instantly)
-    all_active = BreakRecord.query.filter(
+    active = BreakRecord.query.filter(
         BreakRecord.agent_id == current_user.id,
-        BreakRecord.end_time == None
-    ).all()
-    active = next((b for b in all_active if b.break_type not in ['punch_in', 'punch_out']), None)
+        BreakRecord.end_time == None,
+        ~BreakRecord.break_type.in_(PUNCH_TYPES)
+    ).first()
     if active:
         return jsonify({'error': 'You already have an active break'}), 400
     
@@ -946,80 +1357,46 @@ def start_break():
         # For punch_out: Just check if there's a punch_in that hasn't been punched out yet
         # For other breaks: Check punch_in and shift period
         if break_type == 'punch_out':
-            # Find the most recent punch_in (any time, not just today)
-            punch_in = BreakRecord.query.filter(
-                BreakRecord.agent_id == current_user.id,
-                BreakRecord.break_type == 'punch_in'
-            ).order_by(BreakRecord.start_time.desc()).first()
+            # Find the most recent punch_in and punch_out (any time, not just today)
+            latest = latest_punch_times(current_user.id)
             
-            if not punch_in:
+            if 'punch_in' not in latest:
                 return jsonify({
                     'error': 'You must punch in first before punching out. Please punch in to continue.'
                 }), 400
             
             # Check if there's already a punch_out after this punch_in
-            punch_out = BreakRecord.query.filter(
-                BreakRecord.agent_id == current_user.id,
-                BreakRecord.break_type == 'punch_out',
-                BreakRecord.start_time > punch_in.start_time
-            ).order_by(BreakRecord.start_time.desc()).first()
-            
-            if punch_out:
+            if latest.get('punch_out') and latest['punch_out'] > latest['punch_in']:
                 return jsonify({
                     'error': 'You have already punched out after your last punch in.'
                 }), 400
         else:
             # For regular breaks: Check for punch in today OR within last 24 hours (to handle overnight shifts)
-            # First check for today's punch in
-            punch_in = BreakRecord.query.filter(
-                BreakRecord.agent_id == current_user.id,
-                BreakRecord.break_type == 'punch_in',
-                db.func.date(BreakRecord.start_time) == today
-            ).first()
-            
-            # If no punch in today, check for punch in within last 24 hours (for overnight shifts)
-            if not punch_in:
-                twenty_four_hours_ago = now - timedelta(hours=24)
-                punch_in = BreakRecord.query.filter(
-                    BreakRecord.agent_id == current_user.id,
-                    BreakRecord.break_type == 'punch_in',
-                    BreakRecord.start_time >= twenty_four_hours_ago,
-                    BreakRecord.start_time <= now
-                ).order_by(BreakRecord.start_time.desc()).first()
+            # Both punch types are fetched in one query over that window; today's records always
+            # come after the rest of the window, so the latest one is today's if there is one
+            latest = latest_punch_times(
+                current_user.id,
+                since=now - timedelta(hours=24),
+                until=datetime.combine(today + timedelta(days=1), time.min)
+            )
+            punch_in_time = latest.get('punch_in')
+            punch_out_time = latest.get('punch_out')
             
             # IMPORTANT: If punch_in exists, allow breaks regardless of shift period
             # The shift period check was too strict - as long as there's a punch_in and no punch_out,
             # the agent should be able to take breaks
             # Shift period is only used for determining if we need to look in last 24 hours (overnight shifts)
             
-            if not punch_in:
+            if not punch_in_time:
                 return jsonify({
                     'error': 'You must punch in first before taking any breaks. Please punch in to continue.'
                 }), 400
             
-            # Check if already punched out (today or within last 24 hours, and after punch in)
-            punch_out = BreakRecord.query.filter(
-                BreakRecord.agent_id == current_user.id,
-                BreakRecord.break_type == 'punch_out',
-                db.func.date(BreakRecord.start_time) == today
-            ).first()
-            
-            # If no punch out today, check within last 24 hours
-            if not punch_out:
-                twenty_four_hours_ago = now - timedelta(hours=24)
-                punch_out = BreakRecord.query.filter(
-                    BreakRecord.agent_id == current_user.id,
-                    BreakRecord.break_type == 'punch_out',
-                    BreakRecord.start_time >= twenty_four_hours_ago,
-                    BreakRecord.start_time <= now
-                ).order_by(BreakRecord.start_time.desc()).first()
-            
-            # If punched out, check if it's after the punch in
-            if punch_out and punch_in:
-                if punch_out.start_time > punch_in.start_time:
-                    return jsonify({
-                        'error': 'You have already punched out for the day. Breaks are no longer available.'
-                    }), 400
+            # If punched out (today or within last 24 hours), check if it's after the punch in
+            if punch_out_time and punch_out_time > punch_in_time:
+                return jsonify({
+                    'error': 'You have already punched out for the day. Breaks are no longer available.'
+                }), 400
     
     if not screenshot:
         return jsonify({'error': 'Screenshot is required'}), 400
@@ -1038,11 +1415,9 @@ def start_break():
     )
     
     # Auto-complete punch_in and punch_out instantly
-    if break_type in ['punch_in', 'punch_out']:
-        break_record.end_time = break_record.start_time
+    if break_type in PUNCH_TYPES:
         break_record.end_screenshot = screenshot_path
-        break_record.duration_minutes = 0
-        break_record.is_overdue = False
+        break_record.complete(break_record.start_time)
         
         # Prevent duplicate punch records
         if break_type == 'punch_in':
@@ -1050,7 +1425,7 @@ def start_break():
             existing = BreakRecord.query.filter(
                 BreakRecord.agent_id == current_user.id,
                 BreakRecord.break_type == 'punch_in',
-                db.func.date(BreakRecord.start_time) == today
+                started_on(today)
             ).first()
             if existing:
                 return jsonify({'error': 'You have already punched in today'}), 400
@@ -1058,19 +1433,21 @@ def start_break():
     
     db.session.add(break_record)
     db.session.commit()
+    invalidate_break_counters()
+    invalidate_metrics()
     
-    if break_type in ['punch_in', 'punch_out']:
+    if break_type in PUNCH_TYPES:
         action = "Punched in" if break_type == 'punch_in' else "Punched out"
         return jsonify({
             'success': True,
             'message': f'{action} successfully! ✅',
-            'break': break_record.to_dict()
+            'break': break_record.to_dict(agent_name=current_user.full_name)
         })
     
     return jsonify({
         'success': True,
         'message': f'Break started! Return within {BREAK_DURATIONS[break_type]} minutes',
-        'break': break_record.to_dict()
+        'break': break_record.to_dict(agent_name=current_user.full_name)
     })
 
 
@@ -1082,11 +1459,11 @@ def end_break():
         return jsonify({'error': 'RTM cannot take breaks'}), 403
     
     # Get active break (exclude punch_in/punch_out as they're auto-completed instantly)
-    all_active = BreakRecord.query.filter(
+    active = BreakRecord.query.filter(
         BreakRecord.agent_id == current_user.id,
-        BreakRecord.end_time == None
-    ).all()
-    active = next((b for b in all_active if b.break_type not in ['punch_in', 'punch_out']), None)
+        BreakRecord.end_time == None,
+        ~BreakRecord.break_type.in_(PUNCH_TYPES)
+    ).first()
     if not active:
         return jsonify({'error': 'No active break to end'}), 400
     
@@ -1100,25 +1477,18 @@ def end_break():
         return jsonify({'error': 'Invalid screenshot file'}), 400
     
     # Update break record
-    active.end_time = get_local_time().replace(tzinfo=None)
     active.end_screenshot = screenshot_path
-    active.duration_minutes = int((active.end_time - active.start_time).total_seconds() / 60)
-    
-    # Working time breaks (coaching/meetings) and compensation should never be marked as overdue
-    # Working time breaks count as working time regardless of duration
-    # Compensation is for missed work hours, not a violation
-    if active.break_type in WORKING_TIME_BREAKS or active.break_type == 'compensation':
-        active.is_overdue = False
-    else:
-        active.is_overdue = active.duration_minutes > active.get_allowed_duration()
+    active.complete(get_local_time().replace(tzinfo=None))
     
     db.session.commit()
+    invalidate_break_counters()
+    invalidate_metrics()
     
     status = "on time" if not active.is_overdue else "OVERDUE"
     return jsonify({
         'success': True,
         'message': f'Break ended! Duration: {active.duration_minutes} minutes ({status})',
-        'break': active.to_dict()
+        'break': active.to_dict(agent_name=current_user.full_name)
     })
 
 
@@ -1169,15 +1539,15 @@ def create_manual_break():
     
     try:
         # Parse start date and time
-        start_datetime = datetime.strptime(f'{start_date} {start_time}', '%Y-%m-%d %H:%M')
+        start_datetime = datetime.fromisoformat(f'{start_date}T{start_time}')
         
         # Parse end date and time (optional - defaults to start time if not provided)
         if end_date and end_time:
-            end_datetime = datetime.strptime(f'{end_date} {end_time}', '%Y-%m-%d %H:%M')
+            end_datetime = datetime.fromisoformat(f'{end_date}T{end_time}')
             
             # For punch_in and punch_out, start and end times can be the same (instant actions)
             # For other break types, end time must be after start time
-            if break_type not in ['punch_in', 'punch_out']:
+            if break_type not in PUNCH_TYPES:
                 if end_datetime <= start_datetime:
                     return jsonify({'error': 'End time must be after start time'}), 400
             else:
@@ -1186,10 +1556,10 @@ def create_manual_break():
                     end_datetime = start_datetime
         elif end_time:
             # End time provided but no end date - use start date
-            end_datetime = datetime.strptime(f'{start_date} {end_time}', '%Y-%m-%d %H:%M')
+            end_datetime = datetime.fromisoformat(f'{start_date}T{end_time}')
             
             # For punch_in and punch_out, start and end times can be the same
-            if break_type not in ['punch_in', 'punch_out']:
+            if break_type not in PUNCH_TYPES:
                 if end_datetime <= start_datetime:
                     return jsonify({'error': 'End time must be after start time'}), 400
             else:
@@ -1198,7 +1568,7 @@ def create_manual_break():
         else:
             # End time not provided - use start time (for instant actions like punch_in/punch_out)
             # or leave as None for active breaks
-            if break_type in ['punch_in', 'punch_out']:
+            if break_type in PUNCH_TYPES:
                 # For punch_in/punch_out, end time equals start time (instant action)
                 end_datetime = start_datetime
             else:
@@ -1221,12 +1591,12 @@ def create_manual_break():
         
         # For punch_in/punch_out, check for existing records on the same day
         # and warn if there's already one, but allow creation (RTM override)
-        if break_type in ['punch_in', 'punch_out']:
+        if break_type in PUNCH_TYPES:
             punch_date = start_datetime.date()
             existing = BreakRecord.query.filter(
                 BreakRecord.agent_id == int(agent_id),
                 BreakRecord.break_type == break_type,
-                db.func.date(BreakRecord.start_time) == punch_date
+                started_on(punch_date)
             ).first()
             
             if existing:
@@ -1234,50 +1604,36 @@ def create_manual_break():
                 # But we'll still create the record
                 pass
         
-        # Calculate duration
-        # For punch_in/punch_out, duration is 0 (instant actions)
-        # For other breaks, calculate actual duration if end time is provided
-        if break_type in ['punch_in', 'punch_out']:
-            duration_minutes = 0
-            # For punch_in/punch_out, use the same time for both start and end
+        # For punch_in/punch_out, use the same time for both start and end (instant actions)
+        if break_type in PUNCH_TYPES:
             end_datetime = start_datetime
-        elif end_datetime:
-            duration_minutes = int((end_datetime - start_datetime).total_seconds() / 60)
-        else:
-            # Active break (no end time provided)
-            duration_minutes = None
         
         # Create break record
         break_record = BreakRecord(
             agent_id=int(agent_id),
             break_type=break_type,
             start_time=start_datetime.replace(tzinfo=None),
-            end_time=end_datetime.replace(tzinfo=None) if end_datetime else None,
             start_screenshot=start_screenshot_path,
             end_screenshot=end_screenshot_path,
-            duration_minutes=duration_minutes,
             notes=notes
         )
         
-        # Set is_overdue based on break type
-        # punch_in/punch_out, working time breaks, and compensation are never overdue
-        # Compensation is for missed work hours, not a violation
-        # Active breaks (no end time) are not overdue yet
-        if break_type in ['punch_in', 'punch_out', 'compensation'] or break_type in WORKING_TIME_BREAKS:
-            break_record.is_overdue = False
-        elif end_datetime and duration_minutes is not None:
-            break_record.is_overdue = duration_minutes > break_record.get_allowed_duration()
+        if end_datetime:
+            # Derives duration and overdue status (punches are 0 minutes and never overdue)
+            break_record.complete(end_datetime.replace(tzinfo=None))
         else:
-            # Active break - not overdue yet
+            # Active break - no duration and not overdue yet
             break_record.is_overdue = False
         
         db.session.add(break_record)
         db.session.commit()
+        invalidate_break_counters()
+        invalidate_metrics()
         
         return jsonify({
             'success': True,
             'message': f'Manual break created successfully for {agent.full_name}',
-            'break': break_record.to_dict()
+            'break': break_record.to_dict(agent_name=agent.full_name)
         })
         
     except ValueError as e:
@@ -1295,6 +1651,8 @@ def fix_working_time_breaks_endpoint():
         return jsonify({'error': 'Unauthorized'}), 403
     
     fixed_count = fix_existing_working_time_breaks()
+    invalidate_break_counters()
+    invalidate_metrics()
     
     return jsonify({
         'success': True,
@@ -1310,8 +1668,8 @@ def get_agents():
     if not current_user.is_rtm():
         return jsonify({'error': 'Unauthorized'}), 403
     
-    agents = User.query.filter_by(role=ROLE_AGENT).order_by(User.full_name).all()
-    return jsonify({
+    agents = get_agent_roster()
+    return ojsonify({
         'agents': [{'id': a.id, 'username': a.username, 'full_name': a.full_name} for a in agents]
     })
 
@@ -1341,6 +1699,7 @@ def create_agent():
     user.set_password(password)
     db.session.add(user)
     db.session.commit()
+    invalidate_agent_roster()
     
     return jsonify({
         'success': True,
@@ -1348,45 +1707,52 @@ def create_agent():
     })
 
 
+def send_upload(upload_folder, relative_path):
+    """Send a file from the upload folder, letting nginx stream it when configured"""
+    if UPLOADS_ACCEL_REDIRECT:
+        # Access was already checked by the route; nginx serves the bytes from its
+        # internal location so the worker is freed immediately
+        response = Response()
+        response.headers['X-Accel-Redirect'] = UPLOADS_ACCEL_REDIRECT.rstrip('/') + '/' + relative_path
+        # Let nginx set the content type from the file extension
+        del response.headers['Content-Type']
+        return response
+    return send_from_directory(str(upload_folder), relative_path)
+
+
 @app.route('/uploads/<path:filename>')
 @login_required
 def uploaded_file(filename):
     """Serve uploaded files"""
     try:
         upload_folder = Path(app.config['UPLOAD_FOLDER'])
-        file_path = upload_folder / filename
+        # Rejects absolute paths and '..' segments that would escape the upload folder
+        file_path = safe_join(str(upload_folder), filename)
+        if file_path is None:
+            abort(404)
         
         # Check if file exists with the given path
-        if file_path.exists() and file_path.is_file():
-            # File exists - serve it
-            # send_from_directory needs the directory and filename separately
-            if '/' in filename:
-                # Nested path like "2025-12-31/abc123.jpg"
-                directory = upload_folder / filename.rsplit('/', 1)[0]
-                file_only = filename.rsplit('/', 1)[1]
-                return send_from_directory(str(directory), file_only)
-            else:
-                # Just filename, no date folder
-                return send_from_directory(str(upload_folder), filename)
-        
-        # File not found - try backwards compatibility (look in date folders)
-        if '/' not in filename:
-            # Try to find it in any date folder
-            for date_folder in upload_folder.iterdir():
-                if date_folder.is_dir():
-                    potential_path = date_folder / filename
-                    if potential_path.exists() and potential_path.is_file():
-                        return send_from_directory(str(date_folder), filename)
+        # (covers both nested paths like "2025-12-31/abc123.webp" and bare filenames)
+        if os.path.isfile(file_path):
+            return send_upload(upload_folder, filename)
+        
+        # Nested path - the screenshot may still be being written, or stored as the original
+        if '/' in filename:
+            relative_path = wait_for_screenshot(upload_folder, filename)
+            if relative_path is not None:
+                return send_upload(upload_folder, relative_path)
+        else:
+            # File not found - try backwards compatibility (look in date folders)
+            relative_path = find_legacy_upload(upload_folder, filename)
+            if relative_path is not None:
+                return send_upload(upload_folder, relative_path)
         
         # File not found - return 404
-        from flask import abort
         abort(404)
             
     except Exception as e:
         # Log error for debugging
-        import logging
-        logging.error(f"Error serving file {filename}: {str(e)}")
-        from flask import abort
+        logger.error("Error serving file %s: %s", filename, e)
         abort(404)
 
 
@@ -1399,23 +1765,34 @@ def get_shifts():
     if not current_user.is_rtm():
         return jsonify({'error': 'Unauthorized'}), 403
     
-    start_date = request.args.get('start_date', get_local_time().strftime('%Y-%m-%d'))
-    end_date = request.args.get('end_date', start_date)
+    start_date_str = request.args.get('start_date', get_local_time().strftime('%Y-%m-%d'))
+    end_date_str = request.args.get('end_date', start_date_str)
     agent_id = request.args.get('agent_id', '')
     
-    query = Shift.query.filter(
+    try:
+        start_date = date.fromisoformat(start_date_str)
+        end_date = date.fromisoformat(end_date_str)
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    
+    # Select just the serialized columns (with the agent name joined in) rather than
+    # hydrating Shift and User objects for a read-only listing
+    stmt = db.select(
+        Shift.id, Shift.agent_id, User.full_name.label('agent_name'),
+        Shift.start_date, Shift.start_time, Shift.end_date, Shift.end_time
+    ).outerjoin(User, User.id == Shift.agent_id).where(
         Shift.start_date >= start_date,
         Shift.start_date <= end_date
     )
     
     if agent_id:
-        query = query.filter_by(agent_id=int(agent_id))
+        stmt = stmt.where(Shift.agent_id == int(agent_id))
     
-    shifts = query.order_by(Shift.start_date, Shift.start_time).all()
+    rows = db.session.execute(stmt.order_by(Shift.start_date, Shift.start_time)).all()
     
-    return jsonify({
-        'shifts': [s.to_dict() for s in shifts],
-        'total': len(shifts)
+    return ojsonify({
+        'shifts': [Shift.row_to_dict(row, row.agent_name) for row in rows],
+        'total': len(rows)
     })
 
 
@@ -1437,10 +1814,10 @@ def create_bulk_shifts():
         return jsonify({'error': 'All fields are required'}), 400
     
     try:
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-        start_time_obj = datetime.strptime(start_time, '%H:%M').time()
-        end_time_obj = datetime.strptime(end_time, '%H:%M').time()
+        start_date = date.fromisoformat(start_date_str)
+        end_date = date.fromisoformat(end_date_str)
+        start_time_obj = time.fromisoformat(start_time)
+        end_time_obj = time.fromisoformat(end_time)
     except ValueError:
         return jsonify({'error': 'Invalid date or time format'}), 400
     
@@ -1452,9 +1829,6 @@ def create_bulk_shifts():
     if days_diff < 1:
         return jsonify({'error': 'End date must be after start date'}), 400
     
-    created = 0
-    updated = 0
-    
     # Generate all dates in range
     current_date = start_date
     dates_to_create = []
@@ -1462,38 +1836,58 @@ def create_bulk_shifts():
         dates_to_create.append(current_date)
         current_date += timedelta(days=1)
     
-    # Create/update shifts for each agent and each date
-    for agent_id in agent_ids:
-        agent = User.query.filter_by(id=agent_id, role=ROLE_AGENT).first()
-        if not agent:
-            continue
-        
+    # Only existing agents get shifts; one query instead of one per agent
+    valid_agent_ids = [row[0] for row in db.session.execute(
+        db.select(User.id).where(User.id.in_(agent_ids), User.role == ROLE_AGENT)
+    )]
+    
+    # For bulk creation, end_date is same as start_date (single day shifts).
+    # Load every matching shift in the range at once instead of one lookup per agent and day
+    existing = {
+        (row.agent_id, row.start_date): row.id
+        for row in db.session.execute(
+            db.select(Shift.id, Shift.agent_id, Shift.start_date).where(
+                Shift.agent_id.in_(valid_agent_ids),
+                Shift.start_date.between(start_date, end_date),
+                Shift.end_date == Shift.start_date
+            )
+        )
+    }
+    
+    inserts = []
+    update_ids = []
+    for agent_id in valid_agent_ids:
         for shift_date in dates_to_create:
-            # For bulk creation, end_date is same as start_date (single day shifts)
-            existing = Shift.query.filter_by(
-                agent_id=agent_id,
-                start_date=shift_date,
-                end_date=shift_date
-            ).first()
-            if existing:
-                existing.start_time = start_time_obj
-                existing.end_time = end_time_obj
-                updated += 1
+            shift_id = existing.get((agent_id, shift_date))
+            if shift_id is not None:
+                update_ids.append(shift_id)
             else:
-                shift = Shift(
-                    agent_id=agent_id,
-                    start_date=shift_date,
-                    start_time=start_time_obj,
-                    end_date=shift_date,
-                    end_time=end_time_obj,
-                    created_by=current_user.id
-                )
-                db.session.add(shift)
-                created += 1
+                inserts.append({
+                    'agent_id': agent_id,
+                    'start_date': shift_date,
+                    'start_time': start_time_obj,
+                    'end_date': shift_date,
+                    'end_time': end_time_obj,
+                    'created_by': current_user.id
+                })
+    
+    # Every updated shift gets the same times, so a single UPDATE covers them all,
+    # and the new rows go out as one executemany INSERT
+    if update_ids:
+        db.session.execute(
+            db.update(Shift)
+            .where(Shift.id.in_(update_ids))
+            .values(start_time=start_time_obj, end_time=end_time_obj)
+        )
+    if inserts:
+        db.session.execute(db.insert(Shift), inserts)
+    created = len(inserts)
+    updated = len(update_ids)
     
     db.session.commit()
+    invalidate_metrics()
     
-    return jsonify({
+    return ojsonify({
         'success': True,
         'message': f'Created {created} shifts, updated {updated} shifts for {len(dates_to_create)} days',
         'days_created': len(dates_to_create),
@@ -1512,8 +1906,9 @@ def delete_shift(shift_id):
     shift = Shift.query.get_or_404(shift_id)
     db.session.delete(shift)
     db.session.commit()
+    invalidate_metrics()
     
-    return jsonify({'success': True, 'message': 'Shift deleted'})
+    return ojsonify({'success': True, 'message': 'Shift deleted'})
 
 
 @app.route('/api/shift', methods=['POST'])
@@ -1538,10 +1933,10 @@ def create_shift():
             return jsonify({'error': 'All fields are required'}), 400
         
         try:
-            start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-            start_time = datetime.strptime(start_time_str, '%H:%M').time()
-            end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
-            end_time = datetime.strptime(end_time_str, '%H:%M').time()
+            start_date = date.fromisoformat(start_date_str)
+            start_time = time.fromisoformat(start_time_str)
+            end_date = date.fromisoformat(end_date_str)
+            end_time = time.fromisoformat(end_time_str)
         except ValueError as e:
             return jsonify({'error': f'Invalid date or time format: {str(e)}'}), 400
         
@@ -1565,7 +1960,8 @@ def create_shift():
             existing.shift_date = start_date  # Update for backward compatibility
             existing.created_by = current_user.id
             db.session.commit()
-            return jsonify({
+            invalidate_metrics()
+            return ojsonify({
                 'success': True,
                 'message': 'Shift updated',
                 'shift': existing.to_dict()
@@ -1585,18 +1981,16 @@ def create_shift():
         
         db.session.add(shift)
         db.session.commit()
+        invalidate_metrics()
         
-        return jsonify({
+        return ojsonify({
             'success': True,
             'message': 'Shift created',
             'shift': shift.to_dict()
         })
     except Exception as e:
         # Log the error for debugging
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error in create_shift: {e}")
-        print(error_trace)
+        logger.exception("Error in create_shift")
         # Return a proper JSON error response
         return jsonify({
             'error': f'Failed to create shift: {str(e)}',
@@ -1640,10 +2034,10 @@ def create_shift_schedule():
             return jsonify({'error': 'At least one working day must be selected'}), 400
         
         try:
-            start_time = datetime.strptime(start_time_str, '%H:%M').time()
-            end_time = datetime.strptime(end_time_str, '%H:%M').time()
-            period_start_date = datetime.strptime(period_start_date_str, '%Y-%m-%d').date()
-            period_end_date = datetime.strptime(period_end_date_str, '%Y-%m-%d').date()
+            start_time = time.fromisoformat(start_time_str)
+            end_time = time.fromisoformat(end_time_str)
+            period_start_date = date.fromisoformat(period_start_date_str)
+            period_end_date = date.fromisoformat(period_end_date_str)
         except ValueError as e:
             return jsonify({'error': f'Invalid date or time format: {str(e)}'}), 400
         
@@ -1653,14 +2047,35 @@ def create_shift_schedule():
         # Convert working_days to set for faster lookup
         working_days_set = set(working_days)
         
-        total_shifts_created = 0
-        total_offdays_created = 0
+        # Agent ids are compared with the ids read back below, so they must be ints
+        try:
+            agent_ids = [int(agent_id) for agent_id in agent_ids]
+        except (TypeError, ValueError):
+            return jsonify({'error': 'Invalid agent id'}), 400
+        
+        # Load the existing shifts (by start time) and off days for every agent in the
+        # period up front instead of checking each agent and date separately
+        existing_shifts = set(db.session.execute(
+            db.select(Shift.agent_id, Shift.start_date).where(
+                Shift.agent_id.in_(agent_ids),
+                Shift.start_date >= period_start_date,
+                Shift.start_date <= period_end_date,
+                Shift.start_time == start_time
+            )
+        ).tuples())
+        existing_offdays = set(db.session.execute(
+            db.select(OffDay.agent_id, OffDay.off_date).where(
+                OffDay.agent_id.in_(agent_ids),
+                OffDay.off_date >= period_start_date,
+                OffDay.off_date <= period_end_date
+            )
+        ).tuples())
+        
+        new_shifts = []
+        new_offdays = []
         
         # Process each selected agent
         for agent_id in agent_ids:
-            shifts_created = 0
-            offdays_created = 0
-            
             # Iterate through each date in the period
             current_date = period_start_date
             while current_date <= period_end_date:
@@ -1677,50 +2092,44 @@ def create_shift_schedule():
                         # Regular shift: ends same day
                         shift_end_date = current_date
                     
-                    # Check if shift already exists for this date
-                    existing_shift = Shift.query.filter_by(
-                        agent_id=agent_id,
-                        start_date=current_date,
-                        start_time=start_time
-                    ).first()
-                    
-                    if not existing_shift:
-                        shift = Shift(
-                            agent_id=agent_id,
-                            start_date=current_date,
-                            start_time=start_time,
-                            end_date=shift_end_date,
-                            end_time=end_time,
-                            shift_date=current_date,  # For backward compatibility
-                            created_by=current_user.id
-                        )
-                        db.session.add(shift)
-                        shifts_created += 1
-                        total_shifts_created += 1
+                    # Skip if shift already exists for this date
+                    if (agent_id, current_date) not in existing_shifts:
+                        existing_shifts.add((agent_id, current_date))
+                        new_shifts.append({
+                            'agent_id': agent_id,
+                            'start_date': current_date,
+                            'start_time': start_time,
+                            'end_date': shift_end_date,
+                            'end_time': end_time,
+                            'shift_date': current_date,  # For backward compatibility
+                            'created_by': current_user.id
+                        })
                 else:
                     # This is an off day - create an off day record
-                    existing_offday = OffDay.query.filter_by(
-                        agent_id=agent_id,
-                        off_date=current_date
-                    ).first()
-                    
-                    if not existing_offday:
-                        offday = OffDay(
-                            agent_id=agent_id,
-                            off_date=current_date,
-                            reason='Scheduled off day',
-                            created_by=current_user.id
-                        )
-                        db.session.add(offday)
-                        offdays_created += 1
-                        total_offdays_created += 1
+                    if (agent_id, current_date) not in existing_offdays:
+                        existing_offdays.add((agent_id, current_date))
+                        new_offdays.append({
+                            'agent_id': agent_id,
+                            'off_date': current_date,
+                            'reason': 'Scheduled off day',
+                            'created_by': current_user.id
+                        })
                 
                 # Move to next day
                 current_date += timedelta(days=1)
         
+        # One executemany INSERT per table instead of one INSERT per row
+        if new_shifts:
+            db.session.execute(db.insert(Shift), new_shifts)
+        if new_offdays:
+            db.session.execute(db.insert(OffDay), new_offdays)
+        total_shifts_created = len(new_shifts)
+        total_offdays_created = len(new_offdays)
+        
         db.session.commit()
+        invalidate_metrics()
         
-        return jsonify({
+        return ojsonify({
             'success': True,
             'message': f'Schedule created successfully for {len(agent_ids)} agent(s)',
             'shifts_created': total_shifts_created,
@@ -1729,10 +2138,7 @@ def create_shift_schedule():
         })
     except Exception as e:
         db.session.rollback()
-        import traceback
-        error_trace = traceback.format_exc()
-        print(f"Error in create_shift_schedule: {e}")
-        print(error_trace)
+        logger.exception("Error in create_shift_schedule")
         return jsonify({
             'error': f'Failed to create schedule: {str(e)}',
             'details': str(e) if DEBUG else 'Internal server error'
@@ -1749,18 +2155,22 @@ def update_shift(shift_id):
     shift = Shift.query.get_or_404(shift_id)
     data = request.json
     
-    if 'start_date' in data:
-        shift.start_date = datetime.strptime(data['start_date'], '%Y-%m-%d').date()
-    if 'start_time' in data:
-        shift.start_time = datetime.strptime(data['start_time'], '%H:%M').time()
-    if 'end_date' in data:
-        shift.end_date = datetime.strptime(data['end_date'], '%Y-%m-%d').date()
-    if 'end_time' in data:
-        shift.end_time = datetime.strptime(data['end_time'], '%H:%M').time()
+    try:
+        if 'start_date' in data:
+            shift.start_date = date.fromisoformat(data['start_date'])
+        if 'start_time' in data:
+            shift.start_time = time.fromisoformat(data['start_time'])
+        if 'end_date' in data:
+            shift.end_date = date.fromisoformat(data['end_date'])
+        if 'end_time' in data:
+            shift.end_time = time.fromisoformat(data['end_time'])
+    except ValueError as e:
+        return jsonify({'error': f'Invalid date or time format: {str(e)}'}), 400
     
     db.session.commit()
+    invalidate_metrics()
     
-    return jsonify({
+    return ojsonify({
         'success': True,
         'message': 'Shift updated',
         'shift': shift.to_dict()
@@ -1780,24 +2190,28 @@ def get_offdays():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
     
-    query = OffDay.query
+    # Column rows with the agent name joined in, not full OffDay/User objects
+    stmt = db.select(
+        OffDay.id, OffDay.agent_id, User.full_name.label('agent_name'),
+        OffDay.off_date, OffDay.reason, OffDay.created_at
+    ).outerjoin(User, User.id == OffDay.agent_id)
     
     if agent_id:
-        query = query.filter_by(agent_id=agent_id)
+        stmt = stmt.where(OffDay.agent_id == agent_id)
     
     if start_date and end_date:
         try:
-            start = datetime.strptime(start_date, '%Y-%m-%d').date()
-            end = datetime.strptime(end_date, '%Y-%m-%d').date()
-            query = query.filter(OffDay.off_date >= start, OffDay.off_date <= end)
+            start = date.fromisoformat(start_date)
+            end = date.fromisoformat(end_date)
+            stmt = stmt.where(OffDay.off_date >= start, OffDay.off_date <= end)
         except ValueError:
             return jsonify({'error': 'Invalid date format'}), 400
     
-    offdays = query.order_by(OffDay.off_date.desc()).all()
+    rows = db.session.execute(stmt.order_by(OffDay.off_date.desc())).all()
     
-    return jsonify({
-        'offdays': [od.to_dict() for od in offdays],
-        'total': len(offdays)
+    return ojsonify({
+        'offdays': [OffDay.row_to_dict(row, row.agent_name) for row in rows],
+        'total': len(rows)
     })
 
 
@@ -1817,7 +2231,7 @@ def create_offday():
         return jsonify({'error': 'Agent ID and date are required'}), 400
     
     try:
-        off_date = datetime.strptime(off_date_str, '%Y-%m-%d').date()
+        off_date = date.fromisoformat(off_date_str)
     except ValueError:
         return jsonify({'error': 'Invalid date format'}), 400
     
@@ -1832,7 +2246,7 @@ def create_offday():
         existing.reason = reason
         existing.created_by = current_user.id
         db.session.commit()
-        return jsonify({
+        return ojsonify({
             'success': True,
             'message': 'Off day updated',
             'offday': existing.to_dict()
@@ -1848,7 +2262,7 @@ def create_offday():
     db.session.add(offday)
     db.session.commit()
     
-    return jsonify({
+    return ojsonify({
         'success': True,
         'message': 'Off day created',
         'offday': offday.to_dict()
@@ -1866,13 +2280,16 @@ def update_offday(offday_id):
     data = request.json
     
     if 'off_date' in data:
-        offday.off_date = datetime.strptime(data['off_date'], '%Y-%m-%d').date()
+        try:
+            offday.off_date = date.fromisoformat(data['off_date'])
+        except ValueError:
+            return jsonify({'error': 'Invalid date format'}), 400
     if 'reason' in data:
         offday.reason = data['reason']
     
     db.session.commit()
     
-    return jsonify({
+    return ojsonify({
         'success': True,
         'message': 'Off day updated',
         'offday': offday.to_dict()
@@ -1890,72 +2307,223 @@ def delete_offday(offday_id):
     db.session.delete(offday)
     db.session.commit()
     
-    return jsonify({'success': True, 'message': 'Off day deleted'})
+    return ojsonify({'success': True, 'message': 'Off day deleted'})
 
 
 # ==================== REPORTING & EXPORT ====================
 
-def calculate_agent_metrics(agent_id, start_date, end_date):
-    """Calculate all metrics for an agent within a date range"""
+def punch_adherence(actual, scheduled, day_offset=0):
+    """Adherence score (0-100) for a punch at time `actual` vs the `scheduled` time.
+    day_offset is how many days after the scheduled date the punch happened."""
+    # Work from the time components directly instead of building datetimes
+    time_diff_minutes = abs(
+        day_offset * 1440
+        + (actual.hour - scheduled.hour) * 60
+        + (actual.minute - scheduled.minute)
+        + (actual.second - scheduled.second) / 60
+        + (actual.microsecond - scheduled.microsecond) / 60000000
+    )
     
-    # Get all breaks for this agent in date range
-    breaks = BreakRecord.query.filter(
-        BreakRecord.agent_id == agent_id,
-        db.func.date(BreakRecord.start_time) >= start_date,
-        db.func.date(BreakRecord.start_time) <= end_date
-    ).all()
+    # Allow a grace period (early or late)
+    if time_diff_minutes <= PUNCH_GRACE_MINUTES:
+        return 100.0
+    # Penalty: decrease adherence for being late/early
+    # Max penalty at PUNCH_MAX_PENALTY_MINUTES = 0% adherence
+    return max(0, (PUNCH_MAX_PENALTY_MINUTES - time_diff_minutes) / PUNCH_MAX_PENALTY_MINUTES * 100)
+
+
+# Metrics are recomputed from every break and shift in the range, and reports are
+# refreshed often. Ranges that include today keep changing, so they are kept briefly.
+# Past ranges only change when a break or shift is edited, which invalidates the cache
+# in that worker; the TTL bounds how long other workers keep serving the old result
+METRICS_TTL_SECONDS = 30
+PAST_METRICS_TTL_SECONDS = 60
+METRICS_CACHE_MAX_ENTRIES = 64
+# 'entries' maps (agent_ids, start_date, end_date) -> (generation, expires_at, metrics)
+_metrics_cache = {'generation': 0, 'entries': {}}
+
+
+def calculate_all_agent_metrics(agent_ids, start_date, end_date):
+    """Calculate metrics for several agents between two dates (inclusive).
+    Returns {agent_id: metrics}; breaks and shifts are fetched with one query each."""
+    key = (tuple(agent_ids), start_date, end_date)
+    generation = _metrics_cache['generation']
+    entries = _metrics_cache['entries']
+    cached = entries.get(key)
+    if cached and cached[0] == generation and monotonic() < cached[1]:
+        return cached[2]
+    
+    metrics_by_agent = _calculate_all_agent_metrics(agent_ids, start_date, end_date)
+    
+    # A break or shift changed while computing - don't keep the pre-change result
+    if generation != _metrics_cache['generation']:
+        return metrics_by_agent
+    
+    if len(entries) >= METRICS_CACHE_MAX_ENTRIES:
+        # Evict expired entries first, then the oldest ones
+        now = monotonic()
+        for stale_key, (stale_generation, expires_at, _) in list(entries.items()):
+            if stale_generation != generation or now >= expires_at:
+                entries.pop(stale_key, None)
+        for stale_key in list(entries)[:max(0, len(entries) - METRICS_CACHE_MAX_ENTRIES + 1)]:
+            entries.pop(stale_key, None)
+    ttl = METRICS_TTL_SECONDS if end_date >= get_local_time().date() else PAST_METRICS_TTL_SECONDS
+    entries[key] = (generation, monotonic() + ttl, metrics_by_agent)
+    return metrics_by_agent
+
+
+def invalidate_metrics():
+    """Drop cached report metrics (call after breaks or shifts change)"""
+    _metrics_cache['generation'] = next(_cache_generations)
+    _metrics_cache['entries'] = {}
+
+
+def _calculate_all_agent_metrics(agent_ids, start_date, end_date):
+    """Uncached calculate_all_agent_metrics"""
+    break_groups_by_agent = {agent_id: [] for agent_id in agent_ids}
+    punches_by_agent = {agent_id: [] for agent_id in agent_ids}
+    shifts_by_agent = {agent_id: [] for agent_id in agent_ids}
+    
+    # Breaks are only ever summed and counted, so let the database collapse them into
+    # one row per agent, type, duration and status instead of returning every break
+    completed = BreakRecord.end_time.isnot(None)
+    for row in db.session.query(
+        BreakRecord.agent_id, BreakRecord.break_type, BreakRecord.duration_minutes,
+        BreakRecord.is_overdue, completed.label('completed'), db.func.count().label('count')
+    ).filter(
+        BreakRecord.agent_id.in_(agent_ids),
+        started_on(start_date, end_date),
+        ~BreakRecord.break_type.in_(PUNCH_TYPES)
+    ).group_by(
+        BreakRecord.agent_id, BreakRecord.break_type, BreakRecord.duration_minutes,
+        BreakRecord.is_overdue, completed
+    ):
+        break_groups_by_agent[row.agent_id].append(row)
+    
+    # Punch adherence needs the individual punch times
+    for row in db.session.query(
+        BreakRecord.agent_id, BreakRecord.break_type, BreakRecord.start_time
+    ).filter(
+        BreakRecord.agent_id.in_(agent_ids),
+        started_on(start_date, end_date),
+        BreakRecord.break_type.in_(PUNCH_TYPES)
+    ).order_by(BreakRecord.start_time):
+        punches_by_agent[row.agent_id].append(row)
+    
+    # Get all shifts for these agents in date range (shifts that start in the range)
+    for row in db.session.query(
+        Shift.agent_id, Shift.start_date, Shift.start_time, Shift.end_date, Shift.end_time
+    ).filter(
+        Shift.agent_id.in_(agent_ids),
+        Shift.start_date >= start_date,
+        Shift.start_date <= end_date
+    ):
+        shifts_by_agent[row.agent_id].append(row)
     
-    # Get all shifts for this agent in date range (shifts that start in the range)
-    shifts = Shift.query.filter(
-        Shift.agent_id == agent_id,
-        Shift.start_date >= datetime.strptime(start_date, '%Y-%m-%d').date(),
-        Shift.start_date <= datetime.strptime(end_date, '%Y-%m-%d').date()
-    ).all()
+    return {
+        agent_id: calculate_agent_metrics(
+            break_groups_by_agent[agent_id], punches_by_agent[agent_id], shifts_by_agent[agent_id]
+        )
+        for agent_id in agent_ids
+    }
+
+
+# What calculate_agent_metrics returns for an agent with no breaks, punches or shifts
+EMPTY_AGENT_METRICS = {
+    'total_scheduled_hours': 0.0,
+    'total_break_minutes': 0,
+    'total_allowed_break_minutes': 0,
+    'exceeding_break_minutes': 0,
+    'incidents': 0,
+    'emergency_count': 0,
+    'overtime_count': 0,
+    'overtime_minutes': 0,
+    'total_breaks': 0,
+    'completed_breaks': 0,
+    'utilization': 0,
+    'adherence': 100,  # No data = 100% adherence (default)
+    'conformance': 0,
+    'break_counts': {},
+    'lunch_count': 0,
+    'coaching_count': 0,
+    'shifts_count': 0
+}
+
+
+def calculate_agent_metrics(break_groups, punches, shifts):
+    """Calculate all metrics for an agent within a date range.
+    break_groups are (break_type, duration_minutes, is_overdue, completed, count) rows of
+    the agent's non-punch breaks, punches are (break_type, start_time) rows in time order,
+    and shifts are the agent's shift rows."""
+    # Agents with no activity and no shifts in the range (weekends, inactive agents)
+    # get the zero metrics without going through the calculation
+    if not (break_groups or punches or shifts):
+        return {**EMPTY_AGENT_METRICS, 'break_counts': {}}
     
     # Calculate metrics
-    total_scheduled_minutes = sum(s.get_duration_hours() * 60 for s in shifts)
-    
-    # Separate breaks into working time breaks and regular breaks
-    working_time_breaks = [b for b in breaks if b.break_type in WORKING_TIME_BREAKS and b.end_time]
-    # Regular breaks include emergency (emergency counts as break time, not working time)
-    # Compensation is excluded from regular breaks (it's compensation for missed work, not a break violation)
-    regular_breaks = [b for b in breaks if b.break_type not in WORKING_TIME_BREAKS + ['punch_in', 'punch_out', 'compensation'] and b.end_time]
+    total_scheduled_minutes = sum(
+        (datetime.combine(s.end_date, s.end_time)
+         - datetime.combine(s.start_date, s.start_time)).total_seconds() / 60
+        for s in shifts
+    )
     
     # Total break minutes (including emergency - emergency counts as break time)
-    # Excluding working time breaks and punch records
-    total_break_minutes = sum(b.duration_minutes or 0 for b in regular_breaks)
-    total_allowed_break_minutes = sum(b.get_allowed_duration() for b in regular_breaks)
-    exceeding_break_minutes = max(0, total_break_minutes - total_allowed_break_minutes)
-    
+    # Excluding working time breaks, compensation and punch records
+    total_break_minutes = 0
+    total_allowed_break_minutes = 0
+    total_completed_breaks = 0
     # Count incidents (overdue breaks) - only for regular breaks
-    # Compensation is already excluded from regular_breaks, so it won't be counted here
-    # Use effective overdue status (working time breaks are never overdue)
-    incidents = sum(1 for b in regular_breaks if b.get_effective_overdue_status())
-    
-    # Count emergency breaks
-    emergency_count = sum(1 for b in breaks if b.break_type == 'emergency')
-    
-    # Count overtime breaks (in minutes)
-    overtime_breaks = [b for b in breaks if b.break_type == 'overtime' and b.end_time]
-    overtime_count = len(overtime_breaks)
-    overtime_minutes = sum(b.duration_minutes or 0 for b in overtime_breaks)
-    
-    # Count breaks by type (exclude punch_in/punch_out as they're attendance, not breaks)
+    incidents = 0
+    emergency_count = 0
+    overtime_count = 0
+    overtime_minutes = 0
+    compensation_minutes = 0
+    # Count breaks by type (punch_in/punch_out are attendance, not breaks)
     break_counts = {}
-    lunch_count = 0
-    coaching_count = 0
+    # Break duration adherence: sum and number of per-break scores
+    break_score_sum = 0.0
+    break_score_count = 0
     
-    for b in breaks:
-        if b.break_type not in ['punch_in', 'punch_out']:
-            break_counts[b.break_type] = break_counts.get(b.break_type, 0) + 1
-            
-            # Count lunch breaks
-            if b.break_type == 'lunch':
-                lunch_count += 1
+    for row in break_groups:
+        break_type = row.break_type
+        count = row.count
+        break_counts[break_type] = break_counts.get(break_type, 0) + count
+        
+        # Count emergency breaks
+        if break_type == 'emergency':
+            emergency_count += count
+        
+        if not row.completed:
+            continue
+        minutes = (row.duration_minutes or 0) * count
+        
+        if break_type == 'overtime':
+            overtime_count += count
+            overtime_minutes += minutes
+        elif break_type == 'compensation':
+            compensation_minutes += minutes
+        
+        # Regular breaks include emergency (emergency counts as break time, not working time)
+        # Working time breaks and compensation are excluded from regular breaks,
+        # so the stored is_overdue column is the effective overdue status here
+        if break_type not in NON_REGULAR_BREAK_TYPES:
+            allowed = BREAK_DURATIONS.get(break_type, 15)
+            total_completed_breaks += count
+            total_break_minutes += minutes
+            total_allowed_break_minutes += allowed * count
+            if row.is_overdue:
+                incidents += count
             
-            # Count coaching breaks (both coaching_aya and coaching_mostafa)
-            if b.break_type in ['coaching_aya', 'coaching_mostafa']:
-                coaching_count += 1
+            actual = row.duration_minutes
+            if actual is not None and allowed > 0:
+                break_score_sum += (100.0 if actual <= allowed else (allowed / actual) * 100) * count
+                break_score_count += count
+    
+    exceeding_break_minutes = max(0, total_break_minutes - total_allowed_break_minutes)
+    
+    # Count lunch breaks and coaching breaks (both coaching_aya and coaching_mostafa)
+    lunch_count = break_counts.get('lunch', 0)
+    coaching_count = break_counts.get('coaching_aya', 0) + break_counts.get('coaching_mostafa', 0)
     
     # Calculate utilization
     # Working time breaks (coaching/meetings/overtime) count as working time, not breaks
@@ -1963,8 +2531,8 @@ def calculate_agent_metrics(agent_id, start_date, end_date):
     # Expected working hours: 8 hours per shift = 480 minutes
     # Allocated break time: 1 hour 15 minutes per shift = 75 minutes
     if len(shifts) > 0:
-        expected_working_minutes = len(shifts) * 8 * 60  # 8 hours per shift = 480 minutes
-        expected_break_minutes = len(shifts) * 75  # 75 minutes per shift (1 hour 15 minutes allocated break time)
+        expected_working_minutes = len(shifts) * SHIFT_WORKING_MINUTES
+        expected_break_minutes = len(shifts) * SHIFT_BREAK_ALLOWANCE_MINUTES
         
         # If breaks exceed allocated time, utilization decreases
         # Emergency breaks are included in total_break_minutes (they count as break time)
@@ -1976,96 +2544,42 @@ def calculate_agent_metrics(agent_id, start_date, end_date):
         utilization = 0
     
     # Calculate adherence based on:
-    # 1. Break durations (actual vs allowed)
+    # 1. Break durations (actual vs allowed) - accumulated above
     # 2. Punch in time vs shift start time
     # 3. Punch out time vs shift end time
-    
-    adherence_scores = []
-    
-    # 1. Break duration adherence (only for regular breaks)
-    total_completed_breaks = len([b for b in regular_breaks if b.end_time])
-    
-    if total_completed_breaks > 0:
-        for b in regular_breaks:
-            if b.end_time and b.duration_minutes is not None:
-                allowed_duration = b.get_allowed_duration()
-                if allowed_duration > 0:
-                    actual_duration = b.duration_minutes
-                    if actual_duration <= allowed_duration:
-                        break_adherence = 100.0
-                    else:
-                        break_adherence = (allowed_duration / actual_duration) * 100
-                    adherence_scores.append(break_adherence)
+    adherence_sum = break_score_sum
+    adherence_count = break_score_count
     
     # 2. Punch in/out adherence based on shift times
     # Group shifts by start date for easier lookup
     shifts_by_date = {s.start_date: s for s in shifts}
     
-    # Group punch in/out by date
+    # Group punch in/out times of day by date (the latest punch of each type on a day wins)
     punch_records_by_date = {}
-    for b in breaks:
-        if b.break_type in ['punch_in', 'punch_out'] and b.start_time:
-            punch_date = b.start_time.date()
-            if punch_date not in punch_records_by_date:
-                punch_records_by_date[punch_date] = {}
-            punch_records_by_date[punch_date][b.break_type] = b
+    for p in punches:
+        if p.start_time:
+            punch_records_by_date.setdefault(p.start_time.date(), {})[p.break_type] = p.start_time.time()
     
     # Calculate punch in/out adherence for each day with a shift
+    # No punch in or punch out = 0% adherence for that day
     for shift_start_date, shift in shifts_by_date.items():
         punch_records = punch_records_by_date.get(shift_start_date, {})
+        adherence_count += 2
         
         # Punch in adherence
         if 'punch_in' in punch_records:
-            punch_in = punch_records['punch_in']
-            punch_in_time = punch_in.start_time.time()
-            shift_start_time = shift.start_time
-            
-            # Calculate difference in minutes
-            punch_in_datetime = datetime.combine(shift_start_date, punch_in_time)
-            shift_start_datetime = datetime.combine(shift.start_date, shift_start_time)
-            
-            # Allow 5 minutes grace period (early or late)
-            time_diff_minutes = abs((punch_in_datetime - shift_start_datetime).total_seconds() / 60)
-            
-            if time_diff_minutes <= 5:
-                punch_in_adherence = 100.0
-            else:
-                # Penalty: decrease adherence for being late/early
-                # Max penalty at 30 minutes = 0% adherence
-                # Formula: max(0, (30 - time_diff) / 30 * 100)
-                punch_in_adherence = max(0, (30 - time_diff_minutes) / 30 * 100)
-            adherence_scores.append(punch_in_adherence)
-        else:
-            # No punch in = 0% adherence for that day
-            adherence_scores.append(0.0)
+            # Punch in is grouped on the shift start date, so only the time of day differs
+            adherence_sum += punch_adherence(punch_records['punch_in'], shift.start_time)
         
         # Punch out adherence
         if 'punch_out' in punch_records:
-            punch_out = punch_records['punch_out']
-            punch_out_time = punch_out.start_time.time()
-            shift_end_time = shift.end_time
-            
-            # Calculate difference in minutes
-            punch_out_datetime = datetime.combine(punch_out.start_time.date(), punch_out_time)
-            shift_end_datetime = datetime.combine(shift.end_date, shift_end_time)
-            
-            # Allow 5 minutes grace period (early or late)
-            time_diff_minutes = abs((punch_out_datetime - shift_end_datetime).total_seconds() / 60)
-            
-            if time_diff_minutes <= 5:
-                punch_out_adherence = 100.0
-            else:
-                # Penalty: decrease adherence for being late/early
-                # Max penalty at 30 minutes = 0% adherence
-                punch_out_adherence = max(0, (30 - time_diff_minutes) / 30 * 100)
-            adherence_scores.append(punch_out_adherence)
-        else:
-            # No punch out = 0% adherence for that day
-            adherence_scores.append(0.0)
+            # Punches are grouped by their own date, so this one happened on shift_start_date
+            day_offset = (shift_start_date - shift.end_date).days
+            adherence_sum += punch_adherence(punch_records['punch_out'], shift.end_time, day_offset)
     
     # Calculate overall adherence as average of all scores
-    if adherence_scores:
-        adherence = sum(adherence_scores) / len(adherence_scores)
+    if adherence_count:
+        adherence = adherence_sum / adherence_count
     else:
         adherence = 100  # No data = 100% adherence (default)
     
@@ -2074,15 +2588,8 @@ def calculate_agent_metrics(agent_id, start_date, end_date):
     # Actual: scheduled time - excess break time (breaks beyond allocated 75 minutes)
     # Compensation can add working time back
     if len(shifts) > 0:
-        expected_working_minutes = len(shifts) * 8 * 60  # 8 hours per shift
-        expected_break_minutes = len(shifts) * 75  # 75 minutes allocated break time per shift
-        
-        # Get compensation minutes (compensation adds working time)
-        compensation_minutes = sum(
-            b.duration_minutes or 0 
-            for b in breaks 
-            if b.break_type == 'compensation' and b.end_time
-        )
+        expected_working_minutes = len(shifts) * SHIFT_WORKING_MINUTES
+        expected_break_minutes = len(shifts) * SHIFT_BREAK_ALLOWANCE_MINUTES
         
         # Calculate actual working time
         # Emergency breaks are included in total_break_minutes (they reduce working time)
@@ -2102,7 +2609,7 @@ def calculate_agent_metrics(agent_id, start_date, end_date):
         'emergency_count': emergency_count,
         'overtime_count': overtime_count,
         'overtime_minutes': overtime_minutes,
-        'total_breaks': len(breaks),
+        'total_breaks': sum(break_counts.values()) + len(punches),
         'completed_breaks': total_completed_breaks,
         'utilization': round(utilization, 1),
         'adherence': round(adherence, 1),
@@ -2114,22 +2621,16 @@ def calculate_agent_metrics(agent_id, start_date, end_date):
     }
 
 
-@app.route('/api/report/metrics', methods=['GET'])
-@login_required
-def get_metrics():
-    """Get metrics for all agents"""
-    if not current_user.is_rtm():
-        return jsonify({'error': 'Unauthorized'}), 403
-    
-    start_date = request.args.get('start_date', get_local_time().strftime('%Y-%m-%d'))
-    end_date = request.args.get('end_date', start_date)
-    
-    agents = User.query.filter_by(role=ROLE_AGENT).order_by(User.full_name).all()
+def build_metrics_report(start_date, end_date):
+    """Per-agent metrics rows and their totals/averages for a date range.
+    Shared by the metrics API and the Excel export."""
+    agents = get_agent_roster()
     
     results = []
     totals = {
         'total_scheduled_hours': 0,
         'total_break_minutes': 0,
+        'total_allowed_break_minutes': 0,
         'exceeding_break_minutes': 0,
         'incidents': 0,
         'emergency_count': 0,
@@ -2142,8 +2643,9 @@ def get_metrics():
         'agent_count': 0
     }
     
+    metrics_by_agent = calculate_all_agent_metrics([agent.id for agent in agents], start_date, end_date)
     for agent in agents:
-        metrics = calculate_agent_metrics(agent.id, start_date, end_date)
+        metrics = metrics_by_agent[agent.id]
         results.append({
             'agent_id': agent.id,
             'agent_name': agent.full_name,
@@ -2154,6 +2656,7 @@ def get_metrics():
         # Accumulate totals
         totals['total_scheduled_hours'] += metrics['total_scheduled_hours']
         totals['total_break_minutes'] += metrics['total_break_minutes']
+        totals['total_allowed_break_minutes'] += metrics['total_allowed_break_minutes']
         totals['exceeding_break_minutes'] += metrics['exceeding_break_minutes']
         totals['incidents'] += metrics['incidents']
         totals['emergency_count'] += metrics['emergency_count']
@@ -2176,10 +2679,36 @@ def get_metrics():
         totals['avg_adherence'] = 0
         totals['avg_conformance'] = 0
     
-    return jsonify({
+    return results, totals
+
+
+@app.route('/api/report/metrics', methods=['GET'])
+@login_required
+def get_metrics():
+    """Get metrics for all agents"""
+    if not current_user.is_rtm():
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    start_date_str = request.args.get('start_date', get_local_time().strftime('%Y-%m-%d'))
+    end_date_str = request.args.get('end_date', start_date_str)
+    
+    try:
+        start_date = date.fromisoformat(start_date_str)
+        end_date = date.fromisoformat(end_date_str)
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    
+    if end_date < start_date:
+        return jsonify({'error': 'End date must be after start date'}), 400
+    if (end_date - start_date).days + 1 > MAX_REPORT_RANGE_DAYS:
+        return jsonify({'error': f'Date range cannot exceed {MAX_REPORT_RANGE_DAYS} days'}), 400
+    
+    results, totals = build_metrics_report(start_date, end_date)
+    
+    return ojsonify({
         'agents': results,
         'totals': totals,
-        'date_range': {'start': start_date, 'end': end_date}
+        'date_range': {'start': start_date_str, 'end': end_date_str}
     })
 
 
@@ -2197,19 +2726,21 @@ def get_attendance():
     agent_id = request.args.get('agent_id', type=int)
     
     try:
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+        start_date = date.fromisoformat(start_date_str)
+        end_date = date.fromisoformat(end_date_str)
     except ValueError:
         return jsonify({'error': 'Invalid date format'}), 400
     
     if end_date < start_date:
         return jsonify({'error': 'End date must be after start date'}), 400
+    if (end_date - start_date).days + 1 > MAX_REPORT_RANGE_DAYS:
+        return jsonify({'error': f'Date range cannot exceed {MAX_REPORT_RANGE_DAYS} days'}), 400
     
     # Get all agents or specific agent
     if agent_id:
-        agents = User.query.filter_by(id=agent_id, role=ROLE_AGENT).all()
+        agents = [a for a in get_agent_roster() if a.id == agent_id]
     else:
-        agents = User.query.filter_by(role=ROLE_AGENT).order_by(User.full_name).all()
+        agents = get_agent_roster()
     
     attendance_records = []
     summary_stats = {
@@ -2251,7 +2782,7 @@ def get_attendance():
             punch_in = BreakRecord.query.filter(
                 BreakRecord.agent_id == agent.id,
                 BreakRecord.break_type == 'punch_in',
-                db.func.date(BreakRecord.start_time) == current_date
+                started_on(current_date)
             ).first()
             
             # Find matching punch_out (could be on same day or next day for overnight shifts)
@@ -2273,7 +2804,7 @@ def get_attendance():
                 punch_out_today = BreakRecord.query.filter(
                     BreakRecord.agent_id == agent.id,
                     BreakRecord.break_type == 'punch_out',
-                    db.func.date(BreakRecord.start_time) == current_date
+                    started_on(current_date)
                 ).first()
                 
                 if punch_out_today:
@@ -2411,6 +2942,61 @@ def get_attendance():
     })
 
 
+# Excel report styles are immutable, so they are built once rather than per export
+REPORT_TITLE_FONT = Font(bold=True, size=14)
+REPORT_TITLE_ALIGNMENT = Alignment(horizontal="center")
+REPORT_SECTION_FONT = Font(bold=True, size=12)
+REPORT_BOLD_FONT = Font(bold=True)
+REPORT_HEADER_FONT = Font(bold=True, color="FFFFFF", size=11)
+REPORT_HEADER_FILL = PatternFill(start_color="1a73e8", end_color="1a73e8", fill_type="solid")
+REPORT_HEADER_ALIGNMENT = Alignment(horizontal="center", vertical="center", wrap_text=True)
+REPORT_CELL_ALIGNMENT = Alignment(horizontal="center", vertical="center")
+REPORT_BORDER = Border(
+    left=Side(style='thin'),
+    right=Side(style='thin'),
+    top=Side(style='thin'),
+    bottom=Side(style='thin')
+)
+REPORT_GOOD_FILL = PatternFill(start_color="c6efce", end_color="c6efce", fill_type="solid")
+REPORT_WARNING_FILL = PatternFill(start_color="ffeb9c", end_color="ffeb9c", fill_type="solid")
+REPORT_BAD_FILL = PatternFill(start_color="ffc7ce", end_color="ffc7ce", fill_type="solid")
+REPORT_TOTAL_FILL = PatternFill(start_color="e0e0e0", end_color="e0e0e0", fill_type="solid")
+
+METRICS_HEADERS = (
+    "Agent Name",
+    "Username",
+    "Scheduled Hours",
+    "Total Breaks",
+    "Break Time (min)",
+    "Allowed Break (min)",
+    "Exceeding (min)",
+    "Incidents",
+    "Emergency",
+    "Overtime",
+    "Overtime (min)",
+    "Utilization %",
+    "Adherence %",
+    "Conformance %",
+    "Status"
+)
+METRICS_COLUMN_WIDTHS = (20, 15, 15, 12, 15, 15, 12, 10, 10, 10, 12, 12, 12, 12, 15)
+ATTENDANCE_HEADERS = ('Agent Name', 'Date', 'Shift Time', 'Punch In', 'Punch Out', 'Status',
+                      'Hours Worked', 'Late (min)', 'Early Leave (min)')
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+
+
+def styled_cells(ws, values, **style):
+    """Wrap values as write-only cells that all share the given style attributes
+    (font, fill, alignment, border)"""
+    cells = []
+    for value in values:
+        cell = WriteOnlyCell(ws, value=value)
+        for attr, style_value in style.items():
+            setattr(cell, attr, style_value)
+        cells.append(cell)
+    return cells
+
+
 @app.route('/api/attendance/export', methods=['GET'])
 @login_required
 def export_attendance():
@@ -2423,21 +3009,45 @@ def export_attendance():
     agent_id = request.args.get('agent_id', type=int)
     
     try:
-        start_date = datetime.strptime(start_date_str, '%Y-%m-%d').date()
-        end_date = datetime.strptime(end_date_str, '%Y-%m-%d').date()
+        start_date = date.fromisoformat(start_date_str)
+        end_date = date.fromisoformat(end_date_str)
     except ValueError:
         return jsonify({'error': 'Invalid date format'}), 400
     
     if end_date < start_date:
         return jsonify({'error': 'End date must be after start date'}), 400
+    if (end_date - start_date).days + 1 > MAX_REPORT_RANGE_DAYS:
+        return jsonify({'error': f'Date range cannot exceed {MAX_REPORT_RANGE_DAYS} days'}), 400
     
     # Get all agents or specific agent
     if agent_id:
-        agents = User.query.filter_by(id=agent_id, role=ROLE_AGENT).all()
+        agents = [a for a in get_agent_roster() if a.id == agent_id]
     else:
-        agents = User.query.filter_by(role=ROLE_AGENT).order_by(User.full_name).all()
+        agents = get_agent_roster()
+    
+    # Create workbook in write-only mode - rows are streamed to the file instead of
+    # keeping every cell object in memory
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Attendance")
+    
+    # Column widths must be set before the first row is written in write-only mode
+    for col in range(1, len(ATTENDANCE_HEADERS) + 1):
+        ws.column_dimensions[get_column_letter(col)].width = 18
+    
+    ws.append(styled_cells(ws, ATTENDANCE_HEADERS, font=REPORT_HEADER_FONT, fill=REPORT_HEADER_FILL,
+                           alignment=REPORT_HEADER_ALIGNMENT, border=REPORT_BORDER))
+    
+    # Status with emoji
+    status_map = {
+        'on_time': '✅ On Time',
+        'late': '⚠️ Late',
+        'absent': '❌ Absent',
+        'incomplete': '⏳ Incomplete',
+        'off_day': '🏖️ Off Day',
+        'present_no_shift': '✅ Present (No Shift)',
+        'not_scheduled': '➖ Not Scheduled'
+    }
     
-    attendance_records = []
     LATE_TOLERANCE_MINUTES = 5
     
     # Track punch_outs that have already been paired with a punch_in to avoid duplicates
@@ -2463,7 +3073,7 @@ def export_attendance():
             punch_in = BreakRecord.query.filter(
                 BreakRecord.agent_id == agent.id,
                 BreakRecord.break_type == 'punch_in',
-                db.func.date(BreakRecord.start_time) == current_date
+                started_on(current_date)
             ).first()
             
             # Find matching punch_out (could be on same day or next day for overnight shifts)
@@ -2492,7 +3102,7 @@ def export_attendance():
                 punch_out_today = BreakRecord.query.filter(
                     BreakRecord.agent_id == agent.id,
                     BreakRecord.break_type == 'punch_out',
-                    db.func.date(BreakRecord.start_time) == current_date
+                    started_on(current_date)
                 ).first()
                 
                 if punch_out_today and punch_out_today.id not in used_punch_out_ids:
@@ -2561,215 +3171,68 @@ def export_attendance():
                         hours_worked = (now - punch_in_datetime).total_seconds() / 3600
                         status = 'incomplete'
             
-            attendance_records.append({
-                'agent_name': agent.full_name,
-                'date': current_date.isoformat(),
-                'shift': {
-                    'start_time': shift.start_time.strftime('%H:%M') if shift else None,
-                    'end_time': shift.end_time.strftime('%H:%M') if shift else None
-                } if shift else None,
-                'punch_in': {
-                    'time': punch_in.start_time.isoformat() if punch_in else None
-                } if punch_in else None,
-                'punch_out': {
-                    'time': punch_out.start_time.isoformat() if punch_out else None
-                } if punch_out else None,
-                'status': status,
-                'hours_worked': round(hours_worked, 2),
-                'late_minutes': late_minutes,
-                'early_leave_minutes': early_leave_minutes
-            })
+            # Write the row straight to the sheet rather than collecting records first
+            row_data = [
+                agent.full_name,
+                current_date.isoformat(),
+                f"{shift.start_time.strftime('%H:%M')} - {shift.end_time.strftime('%H:%M')}" if shift else '',
+                punch_in.start_time.strftime('%H:%M') if punch_in else '',
+                punch_out.start_time.strftime('%H:%M') if punch_out else '',
+                status_map.get(status, status),
+                round(hours_worked, 2),
+                late_minutes,
+                early_leave_minutes
+            ]
+            ws.append(styled_cells(ws, row_data, alignment=REPORT_CELL_ALIGNMENT, border=REPORT_BORDER))
         
         current_date += timedelta(days=1)
     
-    # Create workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Attendance"
-    
-    # Styles
-    header_font = Font(bold=True, color="FFFFFF", size=11)
-    header_fill = PatternFill(start_color="1a73e8", end_color="1a73e8", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    cell_alignment = Alignment(horizontal="center", vertical="center")
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
-    
-    # Headers
-    headers = ['Agent Name', 'Date', 'Shift Time', 'Punch In', 'Punch Out', 'Status', 'Hours Worked', 'Late (min)', 'Early Leave (min)']
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=1, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-        cell.border = border
-    
-    # Data rows
-    for row_idx, record in enumerate(attendance_records, 2):
-        # Format times
-        punch_in_time = ''
-        if record['punch_in'] and record['punch_in']['time']:
-            dt = datetime.fromisoformat(record['punch_in']['time'].replace('Z', '+00:00'))
-            punch_in_time = dt.strftime('%H:%M')
-        
-        punch_out_time = ''
-        if record['punch_out'] and record['punch_out']['time']:
-            dt = datetime.fromisoformat(record['punch_out']['time'].replace('Z', '+00:00'))
-            punch_out_time = dt.strftime('%H:%M')
-        
-        shift_time = ''
-        if record['shift']:
-            shift_time = f"{record['shift']['start_time']} - {record['shift']['end_time']}"
-        
-        # Status with emoji
-        status_map = {
-            'on_time': '✅ On Time',
-            'late': '⚠️ Late',
-            'absent': '❌ Absent',
-            'incomplete': '⏳ Incomplete',
-            'off_day': '🏖️ Off Day',
-            'present_no_shift': '✅ Present (No Shift)',
-            'not_scheduled': '➖ Not Scheduled'
-        }
-        status_display = status_map.get(record['status'], record['status'])
-        
-        row_data = [
-            record['agent_name'],
-            record['date'],
-            shift_time,
-            punch_in_time,
-            punch_out_time,
-            status_display,
-            record['hours_worked'],
-            record['late_minutes'],
-            record['early_leave_minutes']
-        ]
-        
-        for col, value in enumerate(row_data, 1):
-            cell = ws.cell(row=row_idx, column=col, value=value)
-            cell.alignment = cell_alignment
-            cell.border = border
-    
-    # Auto-adjust column widths
-    for col in range(1, len(headers) + 1):
-        ws.column_dimensions[get_column_letter(col)].width = 18
-    
-    # Save to BytesIO
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    # Save to a temp file so the response can be streamed from disk
+    fd, path = tempfile.mkstemp(suffix='.xlsx', prefix='rta_attendance_')
+    os.close(fd)
+    wb.save(path)
     
     filename = f"attendance_{start_date}_to_{end_date}.xlsx"
-    return Response(
-        output.getvalue(),
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': f'attachment; filename={filename}'}
-    )
+    return send_xlsx_file(path, filename)
 
 
-@app.route('/api/report/export', methods=['GET'])
-@login_required
-def export_report():
-    """Export metrics to Excel"""
-    if not current_user.is_rtm():
-        return jsonify({'error': 'Unauthorized'}), 403
-    
-    start_date = request.args.get('start_date', get_local_time().strftime('%Y-%m-%d'))
-    end_date = request.args.get('end_date', start_date)
-    
-    agents = User.query.filter_by(role=ROLE_AGENT).order_by(User.full_name).all()
-    
-    # Create workbook
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Agent Metrics"
-    
-    # Styles
-    header_font = Font(bold=True, color="FFFFFF", size=11)
-    header_fill = PatternFill(start_color="1a73e8", end_color="1a73e8", fill_type="solid")
-    header_alignment = Alignment(horizontal="center", vertical="center", wrap_text=True)
-    
-    cell_alignment = Alignment(horizontal="center", vertical="center")
-    border = Border(
-        left=Side(style='thin'),
-        right=Side(style='thin'),
-        top=Side(style='thin'),
-        bottom=Side(style='thin')
-    )
+def build_metrics_workbook(start_date, end_date):
+    """Build the agent metrics Excel workbook for a date range (date objects)"""
+    # Create workbook in write-only mode (rows are appended top to bottom)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Agent Metrics")
     
-    good_fill = PatternFill(start_color="c6efce", end_color="c6efce", fill_type="solid")
-    warning_fill = PatternFill(start_color="ffeb9c", end_color="ffeb9c", fill_type="solid")
-    bad_fill = PatternFill(start_color="ffc7ce", end_color="ffc7ce", fill_type="solid")
+    # Column widths must be set before the first row is written in write-only mode
+    for i, width in enumerate(METRICS_COLUMN_WIDTHS, 1):
+        ws.column_dimensions[get_column_letter(i)].width = width
     
     # Title
-    ws.merge_cells('A1:O1')
-    ws['A1'] = f"RTA Agent Metrics Report ({start_date} to {end_date})"
-    ws['A1'].font = Font(bold=True, size=14)
-    ws['A1'].alignment = Alignment(horizontal="center")
+    ws.merged_cells.add('A1:O1')
+    ws.append(styled_cells(ws, [f"RTA Agent Metrics Report ({start_date} to {end_date})"],
+                           font=REPORT_TITLE_FONT, alignment=REPORT_TITLE_ALIGNMENT))
+    ws.append([])
     
     # Headers (row 3)
-    headers = [
-        "Agent Name",
-        "Username", 
-        "Scheduled Hours",
-        "Total Breaks",
-        "Break Time (min)",
-        "Allowed Break (min)",
-        "Exceeding (min)",
-        "Incidents",
-        "Emergency",
-        "Overtime",
-        "Overtime (min)",
-        "Utilization %",
-        "Adherence %",
-        "Conformance %",
-        "Status"
-    ]
-    
-    for col, header in enumerate(headers, 1):
-        cell = ws.cell(row=3, column=col, value=header)
-        cell.font = header_font
-        cell.fill = header_fill
-        cell.alignment = header_alignment
-        cell.border = border
+    ws.append(styled_cells(ws, METRICS_HEADERS, font=REPORT_HEADER_FONT, fill=REPORT_HEADER_FILL,
+                           alignment=REPORT_HEADER_ALIGNMENT, border=REPORT_BORDER))
     
     # Data rows
-    row = 4
-    total_metrics = {
-        'scheduled_hours': 0,
-        'break_minutes': 0,
-        'allowed_minutes': 0,
-        'exceeding': 0,
-        'incidents': 0,
-        'emergency': 0,
-        'breaks': 0,
-        'util_sum': 0,
-        'adh_sum': 0,
-        'conf_sum': 0,
-        'count': 0
-    }
-    
-    for agent in agents:
-        metrics = calculate_agent_metrics(agent.id, start_date, end_date)
-        
+    results, totals = build_metrics_report(start_date, end_date)
+    for metrics in results:
         # Determine status
         if metrics['incidents'] == 0 and metrics['exceeding_break_minutes'] == 0:
             status = "✅ Good"
-            status_fill = good_fill
+            status_fill = REPORT_GOOD_FILL
         elif metrics['incidents'] <= 2 or metrics['exceeding_break_minutes'] <= 15:
             status = "⚠️ Warning"
-            status_fill = warning_fill
+            status_fill = REPORT_WARNING_FILL
         else:
             status = "❌ Needs Review"
-            status_fill = bad_fill
+            status_fill = REPORT_BAD_FILL
         
         row_data = [
-            agent.full_name,
-            agent.username,
+            metrics['agent_name'],
+            metrics['username'],
             metrics['total_scheduled_hours'],
             metrics['total_breaks'],
             metrics['total_break_minutes'],
@@ -2785,102 +3248,213 @@ def export_report():
             status
         ]
         
-        for col, value in enumerate(row_data, 1):
-            cell = ws.cell(row=row, column=col, value=value)
-            cell.alignment = cell_alignment
-            cell.border = border
-            if col == 15:  # Status column
-                cell.fill = status_fill
-        
-        # Accumulate totals
-        total_metrics['scheduled_hours'] += metrics['total_scheduled_hours']
-        total_metrics['break_minutes'] += metrics['total_break_minutes']
-        total_metrics['allowed_minutes'] += metrics['total_allowed_break_minutes']
-        total_metrics['exceeding'] += metrics['exceeding_break_minutes']
-        total_metrics['incidents'] += metrics['incidents']
-        total_metrics['emergency'] += metrics['emergency_count']
-        total_metrics['overtime_count'] = total_metrics.get('overtime_count', 0) + metrics['overtime_count']
-        total_metrics['overtime_minutes'] = total_metrics.get('overtime_minutes', 0) + metrics['overtime_minutes']
-        total_metrics['breaks'] += metrics['total_breaks']
-        if metrics['shifts_count'] > 0:
-            total_metrics['util_sum'] += metrics['utilization']
-            total_metrics['adh_sum'] += metrics['adherence']
-            total_metrics['conf_sum'] += metrics['conformance']
-            total_metrics['count'] += 1
-        
-        row += 1
+        cells = styled_cells(ws, row_data, alignment=REPORT_CELL_ALIGNMENT, border=REPORT_BORDER)
+        cells[14].fill = status_fill  # Status column
+        ws.append(cells)
     
     # Totals/Average row
-    row += 1
-    total_fill = PatternFill(start_color="e0e0e0", end_color="e0e0e0", fill_type="solid")
+    ws.append([])
     
-    avg_util = round(total_metrics['util_sum'] / total_metrics['count'], 1) if total_metrics['count'] > 0 else 0
-    avg_adh = round(total_metrics['adh_sum'] / total_metrics['count'], 1) if total_metrics['count'] > 0 else 0
-    avg_conf = round(total_metrics['conf_sum'] / total_metrics['count'], 1) if total_metrics['count'] > 0 else 0
+    avg_util = totals['avg_utilization']
+    avg_adh = totals['avg_adherence']
+    avg_conf = totals['avg_conformance']
     
     totals_row = [
         "TOTAL / AVERAGE",
-        f"{len(agents)} agents",
-        total_metrics['scheduled_hours'],
-        total_metrics['breaks'],
-        total_metrics['break_minutes'],
-        total_metrics['allowed_minutes'],
-        total_metrics['exceeding'],
-        total_metrics['incidents'],
-        total_metrics['emergency'],
-        total_metrics.get('overtime_count', 0),
-        total_metrics.get('overtime_minutes', 0),
+        f"{len(results)} agents",
+        totals['total_scheduled_hours'],
+        totals['total_breaks'],
+        totals['total_break_minutes'],
+        totals['total_allowed_break_minutes'],
+        totals['exceeding_break_minutes'],
+        totals['incidents'],
+        totals['emergency_count'],
+        totals['overtime_count'],
+        totals['overtime_minutes'],
         avg_util,
         avg_adh,
         avg_conf,
         ""
     ]
     
-    for col, value in enumerate(totals_row, 1):
-        cell = ws.cell(row=row, column=col, value=value)
-        cell.font = Font(bold=True)
-        cell.alignment = cell_alignment
-        cell.border = border
-        cell.fill = total_fill
-    
-    # Adjust column widths
-    column_widths = [20, 15, 15, 12, 15, 15, 12, 10, 10, 10, 12, 12, 12, 12, 15]
-    for i, width in enumerate(column_widths, 1):
-        ws.column_dimensions[get_column_letter(i)].width = width
+    ws.append(styled_cells(ws, totals_row, font=REPORT_BOLD_FONT, alignment=REPORT_CELL_ALIGNMENT,
+                           border=REPORT_BORDER, fill=REPORT_TOTAL_FILL))
     
     # Add a summary section
-    row += 3
-    ws.cell(row=row, column=1, value="Summary").font = Font(bold=True, size=12)
-    row += 1
-    ws.cell(row=row, column=1, value=f"Report Period: {start_date} to {end_date}")
-    row += 1
-    ws.cell(row=row, column=1, value=f"Total Agents: {len(agents)}")
-    row += 1
-    ws.cell(row=row, column=1, value=f"Total Incidents: {total_metrics['incidents']}")
-    row += 1
-    ws.cell(row=row, column=1, value=f"Total Emergency Breaks: {total_metrics['emergency']}")
-    row += 1
-    ws.cell(row=row, column=1, value=f"Total Exceeding Break Time: {total_metrics['exceeding']} minutes")
-    row += 1
-    ws.cell(row=row, column=1, value=f"Average Utilization: {avg_util}%")
-    row += 1
-    ws.cell(row=row, column=1, value=f"Average Adherence: {avg_adh}%")
-    row += 1
-    ws.cell(row=row, column=1, value=f"Average Conformance: {avg_conf}%")
-    
-    # Save to bytes
-    output = io.BytesIO()
-    wb.save(output)
-    output.seek(0)
+    ws.append([])
+    ws.append([])
+    ws.append(styled_cells(ws, ["Summary"], font=REPORT_SECTION_FONT))
+    ws.append([f"Report Period: {start_date} to {end_date}"])
+    ws.append([f"Total Agents: {len(results)}"])
+    ws.append([f"Total Incidents: {totals['incidents']}"])
+    ws.append([f"Total Emergency Breaks: {totals['emergency_count']}"])
+    ws.append([f"Total Exceeding Break Time: {totals['exceeding_break_minutes']} minutes"])
+    ws.append([f"Average Utilization: {avg_util}%"])
+    ws.append([f"Average Adherence: {avg_adh}%"])
+    ws.append([f"Average Conformance: {avg_conf}%"])
+    
+    return wb
+
+
+def send_xlsx_file(path, filename):
+    """Stream a temporary .xlsx file as a download and delete it once sent"""
+    response = send_file(
+        path,
+        mimetype=XLSX_MIMETYPE,
+        as_attachment=True,
+        download_name=filename
+    )
+    response.call_on_close(lambda: os.unlink(path))
+    return response
+
+
+def report_job_paths(job_id):
+    """Status file and finished workbook paths for a background report job"""
+    folder = Path(REPORT_EXPORT_FOLDER)
+    return folder / f"{job_id}.json", folder / f"{job_id}.xlsx"
+
+
+def write_report_job(status_path, job):
+    """Write a job status file atomically, so other workers never read half of it"""
+    part_path = status_path.with_suffix('.json.part')
+    part_path.write_bytes(orjson.dumps(job))
+    os.replace(part_path, status_path)
+
+
+def remove_expired_report_jobs():
+    """Delete report job files older than REPORT_JOB_TTL_SECONDS (failed, stuck or never downloaded)"""
+    cutoff = datetime.now().timestamp() - REPORT_JOB_TTL_SECONDS
+    for entry in Path(REPORT_EXPORT_FOLDER).iterdir():
+        try:
+            if entry.stat().st_mtime < cutoff:
+                entry.unlink()
+        except OSError:
+            pass  # Already removed by another worker
+
+
+def _run_report_job(job_id, start_date, end_date):
+    """Build a metrics report in the background and write it to the job's file"""
+    status_path, xlsx_path = report_job_paths(job_id)
+    part_path = xlsx_path.with_suffix('.xlsx.part')
+    try:
+        with app.app_context():
+            wb = build_metrics_workbook(start_date, end_date)
+            wb.save(part_path)
+        # The workbook only appears under its final name once it is complete
+        os.replace(part_path, xlsx_path)
+    except Exception as e:
+        logger.exception("Report job %s failed", job_id)
+        part_path.unlink(missing_ok=True)
+        try:
+            job = orjson.loads(status_path.read_bytes())
+            job['error'] = str(e)
+            write_report_job(status_path, job)
+        except (OSError, orjson.JSONDecodeError):
+            pass  # Job already expired
+
+
+@app.route('/api/report/export', methods=['GET'])
+@login_required
+def export_report():
+    """Export metrics to Excel"""
+    if not current_user.is_rtm():
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    start_date_str = request.args.get('start_date', get_local_time().strftime('%Y-%m-%d'))
+    end_date_str = request.args.get('end_date', start_date_str)
+    
+    try:
+        start_date = date.fromisoformat(start_date_str)
+        end_date = date.fromisoformat(end_date_str)
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    
+    if end_date < start_date:
+        return jsonify({'error': 'End date must be after start date'}), 400
+    if (end_date - start_date).days + 1 > MAX_REPORT_RANGE_DAYS:
+        return jsonify({'error': f'Date range cannot exceed {MAX_REPORT_RANGE_DAYS} days'}), 400
+    
+    wb = build_metrics_workbook(start_date, end_date)
+    
+    # Save to a temp file so the response can be streamed from disk
+    fd, path = tempfile.mkstemp(suffix='.xlsx', prefix='rta_report_')
+    os.close(fd)
+    wb.save(path)
     
     # Generate filename
     filename = f"RTA_Metrics_{start_date}_to_{end_date}.xlsx"
     
-    return Response(
-        output.getvalue(),
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        headers={'Content-Disposition': f'attachment; filename={filename}'}
-    )
+    return send_xlsx_file(path, filename)
+
+
+@app.route('/api/report/export', methods=['POST'])
+@login_required
+def start_report_export():
+    """Start building a metrics report in the background"""
+    if not current_user.is_rtm():
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    data = request.json or {}
+    start_date_str = data.get('start_date') or get_local_time().strftime('%Y-%m-%d')
+    end_date_str = data.get('end_date') or start_date_str
+    
+    try:
+        start_date = date.fromisoformat(start_date_str)
+        end_date = date.fromisoformat(end_date_str)
+    except ValueError:
+        return jsonify({'error': 'Invalid date format'}), 400
+    
+    if end_date < start_date:
+        return jsonify({'error': 'End date must be after start date'}), 400
+    if (end_date - start_date).days + 1 > MAX_REPORT_RANGE_DAYS:
+        return jsonify({'error': f'Date range cannot exceed {MAX_REPORT_RANGE_DAYS} days'}), 400
+    
+    remove_expired_report_jobs()
+    
+    job_id = uuid.uuid4().hex
+    status_path, _ = report_job_paths(job_id)
+    write_report_job(status_path, {
+        'filename': f"RTA_Metrics_{start_date}_to_{end_date}.xlsx",
+        'owner_id': current_user.id,
+        'started_at': datetime.now().timestamp(),
+    })
+    _report_executor.submit(_run_report_job, job_id, start_date, end_date)
+    
+    return jsonify({'success': True, 'job_id': job_id}), 202
+
+
+@app.route('/api/report/export/<job_id>', methods=['GET'])
+@login_required
+def download_report_export(job_id):
+    """Check a background report job and download the file once it is ready"""
+    if not current_user.is_rtm():
+        return jsonify({'error': 'Unauthorized'}), 403
+    
+    # Job ids are uuid4 hex; anything else can't name a job file
+    if len(job_id) != 32 or not all(c in '0123456789abcdef' for c in job_id):
+        return jsonify({'error': 'Report not found'}), 404
+    
+    status_path, xlsx_path = report_job_paths(job_id)
+    try:
+        job = orjson.loads(status_path.read_bytes())
+    except (OSError, orjson.JSONDecodeError):
+        return jsonify({'error': 'Report not found'}), 404
+    if job['owner_id'] != current_user.id:
+        return jsonify({'error': 'Report not found'}), 404
+    
+    if 'error' in job:
+        status_path.unlink(missing_ok=True)
+        return jsonify({'error': f"Failed to build report: {job['error']}"}), 500
+    
+    if not xlsx_path.exists():
+        # The worker building it was probably restarted - don't leave the browser polling
+        if datetime.now().timestamp() - job['started_at'] > REPORT_JOB_MAX_BUILD_SECONDS:
+            status_path.unlink(missing_ok=True)
+            return jsonify({'error': 'Report took too long to build, please try again'}), 500
+        return jsonify({'status': 'pending'}), 202
+    
+    status_path.unlink(missing_ok=True)
+    return send_xlsx_file(str(xlsx_path), job['filename'])
 
 
 # ==================== STARTUP ====================
@@ -2895,17 +3469,21 @@ def fix_existing_working_time_breaks():
             print("⚠️ Database tables not initialized yet, skipping fix")
             return 0
         
-        working_time_breaks = BreakRecord.query.filter(
-            BreakRecord.break_type.in_(WORKING_TIME_BREAKS),
-            BreakRecord.is_overdue == True
-        ).all()
+        # Single UPDATE statement - no need to load the rows into the session
+        result = db.session.execute(
+            db.update(BreakRecord)
+            .where(
+                BreakRecord.break_type.in_(WORKING_TIME_BREAKS),
+                BreakRecord.is_overdue == True
+            )
+            .values(is_overdue=False)
+        )
+        db.session.commit()
         
-        if working_time_breaks:
-            for br in working_time_breaks:
-                br.is_overdue = False
-            db.session.commit()
-            print(f"✅ Fixed {len(working_time_breaks)} working time breaks that were incorrectly marked as overdue")
-        return len(working_time_breaks)
+        fixed_count = result.rowcount
+        if fixed_count:
+            print(f"✅ Fixed {fixed_count} working time breaks that were incorrectly marked as overdue")
+        return fixed_count
     except Exception as e:
         print(f"⚠️ Error fixing working time breaks: {e}")
         import traceback
@@ -2920,8 +3498,16 @@ def create_app():
         fix_existing_working_time_breaks()
     return app
 
-# Initialize on import (for gunicorn)
-create_app()
+
+@app.cli.command('init-db')
+def init_db_command():
+    """Create tables, run migrations and fix existing data (for INIT_DB_ON_STARTUP=0)"""
+    create_app()
+    print("✅ Database initialized")
+
+# Initialize on import (for gunicorn) unless it is run as a separate deploy step
+if INIT_DB_ON_STARTUP:
+    create_app()
 
 # ==================== MAIN ====================
 
@@ -3,8 +3,9 @@ RTA Break Tracker Web - Configuration
 Supports both development and production environments
 """
 import os
+import tempfile
 from pathlib import Path
-import pytz
+from zoneinfo import ZoneInfo
 
 # Base directory
 BASE_DIR = Path(__file__).parent
@@ -17,11 +18,27 @@ DEBUG = ENV == 'development'
 # Egypt: 'Africa/Cairo'
 # Saudi Arabia: 'Asia/Riyadh'
 # UAE: 'Asia/Dubai'
-TIMEZONE = pytz.timezone(os.environ.get('TIMEZONE', 'Africa/Cairo'))
+TIMEZONE = ZoneInfo(os.environ.get('TIMEZONE', 'Africa/Cairo'))
 
 # Secret key (CHANGE IN PRODUCTION via environment variable!)
 SECRET_KEY = os.environ.get('SECRET_KEY', 'rta-break-tracker-dev-key-change-in-production')
 
+# bcrypt cost for password hashes - each step doubles login CPU time
+# (the library default of 12 costs ~200ms per login). Stored hashes with a
+# lower cost are re-hashed on the next successful login; stronger ones are kept.
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 10))
+
+# Failed logins allowed per client address and username before further attempts from
+# that address are refused for the rest of the window. Counted per worker process, so
+# it slows down guessing rather than giving an exact limit
+LOGIN_MAX_FAILURES = int(os.environ.get('LOGIN_MAX_FAILURES', 5))
+LOGIN_FAILURE_WINDOW_SECONDS = int(os.environ.get('LOGIN_FAILURE_WINDOW_SECONDS', 300))
+
+# Number of reverse proxies in front of the app (the host's router, nginx...).
+# When set, the client address is taken from X-Forwarded-For; leave at 0 when the app
+# is reached directly, otherwise clients could spoof their address
+TRUSTED_PROXY_COUNT = int(os.environ.get('TRUSTED_PROXY_COUNT', 0))
+
 # Database Configuration
 # Use PostgreSQL in production, SQLite in development
 DATABASE_URL = os.environ.get('DATABASE_URL')
@@ -32,19 +49,40 @@ if DATABASE_URL:
     if DATABASE_URL.startswith('postgres://'):
         DATABASE_URL = DATABASE_URL.replace('postgres://', 'postgresql://', 1)
     SQLALCHEMY_DATABASE_URI = DATABASE_URL
+    # Connection pool sized for threaded workers (see Procfile)
+    # pre_ping/recycle drop connections the server has closed before they're used
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        # Fail fast instead of queueing requests for the default 30s when the pool is exhausted
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 10)),
+        'pool_pre_ping': True,
+        'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 1800)),
+    }
 else:
     # Development: Use SQLite
     DATABASE_PATH = BASE_DIR / 'data' / 'database.db'
     SQLALCHEMY_DATABASE_URI = f'sqlite:///{DATABASE_PATH}'
+    SQLALCHEMY_ENGINE_OPTIONS = {}
     (BASE_DIR / 'data').mkdir(exist_ok=True)
 
 SQLALCHEMY_TRACK_MODIFICATIONS = False
 
+# Create tables, run the column migrations and repair data when the app is imported.
+# With several gunicorn workers every worker repeats this on boot; set to 0 and run
+# `flask --app app init-db` once per deploy instead.
+INIT_DB_ON_STARTUP = os.environ.get('INIT_DB_ON_STARTUP', '1') == '1'
+
 # Uploads Configuration
 # Use cloud storage URL if provided, otherwise local
 UPLOAD_FOLDER = os.environ.get('UPLOAD_FOLDER', str(BASE_DIR / 'uploads'))
 MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16MB max upload
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp'}
+ALLOWED_EXTENSIONS = frozenset({'png', 'jpg', 'jpeg', 'gif', 'bmp'})
+
+# Internal nginx location that maps to UPLOAD_FOLDER (e.g. '/internal_uploads/').
+# When set, screenshots are handed off to nginx with X-Accel-Redirect instead of
+# being streamed through the app. Leave empty when not running behind nginx.
+UPLOADS_ACCEL_REDIRECT = os.environ.get('UPLOADS_ACCEL_REDIRECT', '')
 
 # Ensure upload directory exists (for local storage)
 Path(UPLOAD_FOLDER).mkdir(parents=True, exist_ok=True)
@@ -81,17 +119,37 @@ BREAK_INFO = {
     "meeting_team_leader": {"name": "Meeting (Team Leader)", "emoji": "👔", "color": "#9c27b0"}
 }
 
+# Metrics Configuration (in minutes)
+SHIFT_WORKING_MINUTES = 8 * 60  # Expected working time per shift
+SHIFT_BREAK_ALLOWANCE_MINUTES = 75  # Allocated break time per shift (1 hour 15 minutes)
+PUNCH_GRACE_MINUTES = 5  # Punches this close to the shift time score 100% adherence
+PUNCH_MAX_PENALTY_MINUTES = 30  # Punches this far off (or more) score 0% adherence
+# Longest date range (in days) accepted by the metrics and attendance reports/exports
+MAX_REPORT_RANGE_DAYS = int(os.environ.get('MAX_REPORT_RANGE_DAYS', 92))
+
+# Background report exports are written here with a small status file per job, so the
+# download can be served by any worker (or any instance sharing this folder).
+# Jobs that fail, never finish or are never downloaded are removed after the TTL
+REPORT_EXPORT_FOLDER = os.environ.get('REPORT_EXPORT_FOLDER', str(Path(tempfile.gettempdir()) / 'rta_reports'))
+REPORT_JOB_TTL_SECONDS = int(os.environ.get('REPORT_JOB_TTL_SECONDS', 3600))
+# A job still unfinished after this long is reported as failed (its worker was most
+# likely restarted); the browser stops polling at about the same time
+REPORT_JOB_MAX_BUILD_SECONDS = int(os.environ.get('REPORT_JOB_MAX_BUILD_SECONDS', 300))
+Path(REPORT_EXPORT_FOLDER).mkdir(parents=True, exist_ok=True)
+
 # User Roles
 ROLE_AGENT = "agent"
 ROLE_RTM = "rtm"
 
 # Default admin account (created on first run)
 # In production, change password immediately after first login!
-DEFAULT_USERS = [
-    {
-        "username": os.environ.get('ADMIN_USERNAME', 'admin'),
-        "password": os.environ.get('ADMIN_PASSWORD', 'admin123'),
-        "full_name": "RTM Admin",
-        "role": ROLE_RTM
-    },
-]
+# Built on demand so the plaintext password isn't kept in a module global
+def get_default_users():
+    return (
+        {
+            "username": os.environ.get('ADMIN_USERNAME', 'admin'),
+            "password": os.environ.get('ADMIN_PASSWORD', 'admin123'),
+            "full_name": "RTM Admin",
+            "role": ROLE_RTM
+        },
+    )
@@ -925,7 +925,7 @@ async function loadMetrics() {
     }
 }
 
-function exportToExcel() {
+async function exportToExcel() {
     const startDate = document.getElementById('reportStartDate').value;
     const endDate = document.getElementById('reportEndDate').value;
     
@@ -934,8 +934,48 @@ function exportToExcel() {
         return;
     }
     
-    // Trigger download
-    window.location.href = `/api/report/export?start_date=${startDate}&end_date=${endDate}`;
+    try {
+        // Build the report in the background, then poll until it's ready
+        const response = await fetch('/api/report/export', {
+            method: 'POST',
+            headers: { 'Content-Type': 'application/json' },
+            body: JSON.stringify({ start_date: startDate, end_date: endDate })
+        });
+        const data = await response.json();
+        if (!response.ok) {
+            throw new Error(data.error || 'Failed to start export');
+        }
+        
+        // The server gives up on a job after 5 minutes; stop polling a little later either way
+        const jobUrl = `/api/report/export/${data.job_id}`;
+        const maxPolls = 330;
+        for (let poll = 0; ; poll++) {
+            const status = await fetch(jobUrl, { method: 'GET' });
+            if (status.status === 202) {
+                if (poll >= maxPolls) {
+                    throw new Error('Report is taking too long, please try again');
+                }
+                await new Promise(resolve => setTimeout(resolve, 1000));
+                continue;
+            }
+            if (!status.ok) {
+                const err = await status.json();
+                throw new Error(err.error || 'Failed to build report');
+            }
+            // Report is ready - the next request to this URL would 404, so download the blob
+            const blob = await status.blob();
+            const link = document.createElement('a');
+            link.href = URL.createObjectURL(blob);
+            link.download = `RTA_Metrics_${startDate}_to_${endDate}.xlsx`;
+            document.body.appendChild(link);
+            link.click();
+            link.remove();
+            URL.revokeObjectURL(link.href);
+            break;
+        }
+    } catch (err) {
+        alert('Export failed: ' + err.message);
+    }
 }
 
 // ==================== ATTENDANCE MANAGEMENT ====================